@@ -1,3 +1,4 @@
+import atexit
 from collections import defaultdict
 import colorama
 from copy import copy
@@ -12,8 +13,10 @@ from os import path
 import subprocess
 from subprocess import PIPE
 import tempfile
+import threading
 
 from causeway.because_data import CausationInstance
+from causeway.cache import DiskCache
 from causeway.because_data.iaa import CausalityMetrics
 from nlpypline.data import StanfordParsedSentence
 from nlpypline.pipeline import Stage, Evaluator
@@ -31,6 +34,19 @@ try:
     DEFINE_string(
         'stanford_ner_model_name', 'english.all.3class.distsim.crf.ser.gz',
         'Name of model file for Stanford NER')
+    DEFINE_bool('stanford_ner_persistent', True,
+                'Whether to tag with a single long-lived Stanford NER process'
+                ' (requires the NERServer Stanford patch), rather than'
+                ' launching NER and reloading its model for every batch')
+    DEFINE_string('stanford_ner_cache_path',
+                  path.expanduser(path.join('~', 'ner_cache', 'ner.db')),
+                  'Path of the database in which to cache NER tags for each'
+                  ' token sequence. Set to the empty string to disable'
+                  ' caching.')
+    DEFINE_bool('stanford_ner_candidates_only', True,
+                'Whether to run NER only on sentences that have possible'
+                ' causations (when an earlier stage has produced them); other'
+                " sentences' tokens get no NER tags")
     DEFINE_bool('print_patterns', False,
                 'Whether to print all connective patterns')
     DEFINE_bool('patterns_print_test_instances', False,
@@ -247,8 +263,87 @@ class SentenceSplitStanfordNERTagger(StanfordNERTagger):
             '\"tokenizeNLs=false\"']
 
 
+class NERWorker(object):
+    '''
+    A long-lived NERServer process (see stanford-patches), which loads the NER
+    model once and then tags batches of tokenized sentences sent over a pipe.
+    Workers are shared by everything in the process that uses the same model
+    (e.g., every fold of a cross-validation run); use `get_worker` to get one.
+    '''
+
+    _END_LINE = '%%END'
+    _ENCODING = 'utf-8'
+    _workers = {} # (model path, jar path) -> worker
+
+    @classmethod
+    def get_worker(cls, model_path, jar_path):
+        try:
+            return cls._workers[(model_path, jar_path)]
+        except KeyError:
+            worker = cls(model_path, jar_path)
+            cls._workers[(model_path, jar_path)] = worker
+            return worker
+
+    def __init__(self, model_path, jar_path):
+        self.process = subprocess.Popen(
+            ['java', '-mx1000m', '-cp', jar_path,
+             'edu.stanford.nlp.ie.crf.NERServer', '-encoding', self._ENCODING,
+             model_path],
+            stdin=PIPE, stdout=PIPE)
+        atexit.register(self.close)
+
+    def tag_sents(self, sentences):
+        '''
+        Tags each sentence in `sentences` (each a list of token strings).
+        Returns a list of (token, tag) pairs for each sentence, just like
+        `StanfordNERTagger.tag_sents`.
+        '''
+        # The request is written from a separate thread, so that a big batch
+        # can't deadlock with NER waiting for us to read its output.
+        def write_request():
+            self.process.stdin.write('%d\n' % len(sentences))
+            for sentence in sentences:
+                self.process.stdin.write(
+                    u' '.join(sentence).encode(self._ENCODING) + '\n')
+            self.process.stdin.flush()
+        writer = threading.Thread(target=write_request)
+        writer.start()
+
+        results = []
+        for sentence in sentences:
+            # Tags are separated by single spaces. (Splitting on any Unicode
+            # whitespace could break up a tag line differently than NER split
+            # the tokens.)
+            tags_line = self._read_line()
+            tags = tags_line.split(' ') if tags_line else []
+            if len(tags) != len(sentence):
+                raise RuntimeError(
+                    'NER returned %d tags for %d tokens (sentence: %s)'
+                    % (len(tags), len(sentence), u' '.join(sentence)))
+            results.append(zip(sentence, tags))
+        if self._read_line() != self._END_LINE:
+            raise RuntimeError('Unexpected extra output from NER')
+        writer.join()
+        return results
+
+    def _read_line(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError('NER process exited unexpectedly')
+        return line.decode(self._ENCODING).rstrip('\n')
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
 class StanfordNERStage(Stage):
     NER_TYPES = Enum(['Person', 'Organization', 'Location', 'O'])
+    # Bump this whenever the tags NER produces for the same tokens and model
+    # change, so that cached tags from older code don't get reused. (Version 1
+    # tags came from an NERServer that skipped word-shape preprocessing.)
+    _NER_CACHE_VERSION = '2'
 
     def __init__(self, name):
         self.name = name
@@ -261,17 +356,33 @@ class StanfordNERStage(Stage):
         model_path = path.join(FLAGS.stanford_ner_path, 'classifiers',
                                FLAGS.stanford_ner_model_name)
         jar_path = path.join(FLAGS.stanford_ner_path, FLAGS.stanford_ner_jar)
-        tagger = SentenceSplitStanfordNERTagger(model_path, jar_path)
+        if FLAGS.stanford_ner_persistent:
+            tagger = NERWorker.get_worker(model_path, jar_path)
+        else:
+            tagger = SentenceSplitStanfordNERTagger(model_path, jar_path)
+        all_sentences = list(chain.from_iterable(sentences_by_doc))
+        if FLAGS.stanford_ner_candidates_only:
+            # NER tags are only used as features of possible causations, so
+            # sentences without any don't need tagging.
+            sentences_to_tag = [
+                sentence for sentence in all_sentences
+                if getattr(sentence, 'possible_causations', True)]
+            logging.info('Running NER on %d of %d sentences',
+                         len(sentences_to_tag), len(all_sentences))
+            for sentence in all_sentences:
+                if not getattr(sentence, 'possible_causations', True):
+                    for token in sentence.tokens:
+                        token.ner_tag = None
+        else:
+            sentences_to_tag = all_sentences
         tokens_by_sentence = [
             [StanfordParsedSentence.escape_token_text(token.original_text)
              # Omit fictitious tokens.
              for token in sentence.tokens if token.start_offset is not None]
-            for sentence in chain.from_iterable(sentences_by_doc)]
+            for sentence in sentences_to_tag]
 
-        # Batch process sentences (faster than repeatedly running Stanford NLP)
-        ner_results = tagger.tag_sents(tokens_by_sentence)
-        all_sentences = chain.from_iterable(sentences_by_doc)
-        for sentence, sentence_result in zip(all_sentences, ner_results):
+        ner_results = self._tag_with_cache(tagger, tokens_by_sentence)
+        for sentence, sentence_result in zip(sentences_to_tag, ner_results):
             sentence_result_iter = iter(sentence_result)
             for token in sentence.tokens:
                 if token.start_offset is None: # Ignore fictitious tokens.
@@ -287,9 +398,62 @@ class StanfordNERStage(Stage):
             except StopIteration:
                 pass
 
-            if writer:
+        if writer:
+            for sentence in all_sentences:
                 writer.instance_complete(sentence)
 
+    @staticmethod
+    def _tag_with_cache(tagger, tokens_by_sentence):
+        '''
+        Returns the tagger's results for each sentence in `tokens_by_sentence`,
+        running the tagger only on the sentences whose tags aren't cached. The
+        tags depend only on the tokens and the model, so they're cached under
+        those.
+        '''
+        if not FLAGS.stanford_ner_cache_path:
+            return tagger.tag_sents(tokens_by_sentence)
+
+        cache = DiskCache(FLAGS.stanford_ner_cache_path)
+        try:
+            cache_keys = [
+                DiskCache.make_key('ner', StanfordNERStage._NER_CACHE_VERSION,
+                                   FLAGS.stanford_ner_model_name, *tokens)
+                for tokens in tokens_by_sentence]
+            cached_tags = cache.get_many(cache_keys)
+            ner_results = []
+            for tokens, cache_key in zip(tokens_by_sentence, cache_keys):
+                try:
+                    tags_string = cached_tags[cache_key]
+                except KeyError:
+                    ner_results.append(None)
+                    continue
+                tags = tags_string.split(' ') if tags_string else []
+                ner_results.append(zip(tokens, tags))
+
+            uncached_indices = [i for i, result in enumerate(ner_results)
+                                if result is None]
+            logging.info('Found cached NER tags for %d of %d sentences',
+                         len(ner_results) - len(uncached_indices),
+                         len(ner_results))
+            if uncached_indices:
+                # Batch process sentences (faster than repeatedly running
+                # Stanford NLP)
+                new_results = tagger.tag_sents(
+                    [tokens_by_sentence[i] for i in uncached_indices])
+                tags_to_cache = []
+                for i, result in zip(uncached_indices, new_results):
+                    ner_results[i] = result
+                    # Results that don't line up with the tokens will fail
+                    # later; don't keep them around.
+                    if len(result) == len(tokens_by_sentence[i]):
+                        tags_string = u' '.join(tag for _, tag in result)
+                        tags_to_cache.append(
+                            (cache_keys[i], tags_string.encode('utf-8')))
+                cache.put_many(tags_to_cache)
+        finally:
+            cache.close()
+        return ner_results
+
 
 def remove_smaller_matches(sentence):
     causations_by_size = defaultdict(list) # causation instances by conn. size
@@ -320,6 +484,46 @@ def remove_smaller_matches(sentence):
 RELATIVE_POSITIONS = Enum(['Before', 'Overlapping', 'After'])
 
 
+class LemmaIndex(object):
+    '''
+    Inverted index from token lemmas to the sorted indices of the sentences
+    that contain them. Used to quickly find the sentences that could possibly
+    match a connective pattern, without rescanning every sentence's tokens for
+    every pattern.
+    '''
+
+    def __init__(self, sentences):
+        self.num_sentences = len(sentences)
+        postings = defaultdict(list)
+        for i, sentence in enumerate(sentences):
+            for lemma in set([token.lemma for token in sentence.tokens]):
+                postings[lemma].append(i)
+        self._postings = dict(postings)
+        # Sets for fast membership tests when intersecting posting lists.
+        self._posting_sets = {lemma: set(indices)
+                              for lemma, indices in postings.iteritems()}
+
+    def get_sentence_indices(self, lemmas):
+        '''
+        Returns the sorted indices of all sentences that contain every lemma in
+        `lemmas`.
+        '''
+        lemmas = set(lemmas)
+        if not lemmas:
+            return range(self.num_sentences)
+        try:
+            postings = sorted([self._postings[lemma] for lemma in lemmas],
+                              key=len)
+        except KeyError: # Some lemma doesn't appear anywhere
+            return []
+
+        # Walk the shortest posting list, checking the others for membership.
+        other_sets = [self._posting_sets[lemma] for lemma in lemmas
+                      if self._postings[lemma] is not postings[0]]
+        return [i for i in postings[0]
+                if all([i in other_set for other_set in other_sets])]
+
+
 def get_causation_tuple(connective_tokens, cause_head, effect_head):
     return (tuple(t.index for t in connective_tokens),
             cause_head.index if cause_head else None,
@@ -8,15 +8,23 @@ from __future__ import absolute_import, print_function
 from bidict import bidict
 from collections import defaultdict
 from copy import copy, deepcopy
-from gflags import FLAGS, DuplicateFlagError, DEFINE_bool
+import cPickle
+from gflags import (FLAGS, DuplicateFlagError, DEFINE_bool, DEFINE_integer,
+                    DEFINE_string)
+import glob
+import hashlib
 import logging
-from nltk.tree import ImmutableParentedTree
+import multiprocessing
 import numpy as np
 import os
-from scipy.sparse.lil import lil_matrix
+from os import path
+import re
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import shortest_path
 
 from nlpypline.data import Annotation, Token, StanfordParsedSentence
-from nlpypline.data.io import (DocumentReader, StanfordParsedSentenceReader,
+from nlpypline.data.io import (DocumentReader, DirectoryReader,
+                               StanfordParsedSentenceReader,
                                InstancesDocumentWriter)
 from nlpypline.util import listify, Enum, make_getter, make_setter, Object
 from textwrap import TextWrapper
@@ -28,6 +36,14 @@ try:
     DEFINE_bool('reader_ignore_overlapping', False,
                 'Whether, when reading causality data, instances with an'
                 ' accompanying overlapping relation should be ignored')
+    DEFINE_string('reader_cache_dir',
+                  path.expanduser(path.join('~', 'reader_cache')),
+                  'Directory in which to cache fully read documents, so that'
+                  ' unchanged documents needn\'t be re-parsed on every run.'
+                  ' Set to the empty string to disable caching.')
+    DEFINE_integer('reader_processes', 1,
+                   'Number of worker processes to use for reading the documents'
+                   ' in a directory')
 except DuplicateFlagError as e:
     logging.warn('Ignoring flag redefinitions; assuming module reload')
 
@@ -37,6 +53,21 @@ class CausewaySentence(StanfordParsedSentence):
         super(CausewaySentence, self).__init__(*args, **kwargs)
         self.causation_instances = []
         self.overlapping_rel_instances = []
+        self._dep_ptb_tree_string = None # memoized by dep_to_ptb_tree_string
+        self._constituency_tables = None # built by get_constituency_tables
+        self._constituency_paths = None # built by get_constituency_paths
+
+    def __getstate__(self):
+        # The constituency tables identify subtrees by object ID, which
+        # doesn't survive pickling or copying (which uses this, too), so
+        # copies rebuild them instead.
+        try:
+            state = super(CausewaySentence, self).__getstate__()
+        except AttributeError: # no parent class customizes its state
+            state = self.__dict__
+        state = dict(state)
+        state['_constituency_tables'] = None
+        return state
 
     def add_causation_instance(self, *args, **kwargs):
         instance = CausationInstance(self, *args, **kwargs)
@@ -48,10 +79,67 @@ class CausewaySentence(StanfordParsedSentence):
         self.overlapping_rel_instances.append(instance)
         return instance
 
+    class ConstituencyTables(object):
+        '''
+        Lookup tables for a constituency tree, which would otherwise have to be
+        recomputed by walking the tree each time:
+         - `treepositions`: the treepositions of all nodes, including leaves,
+           in preorder (the order in which TRegex numbers nodes);
+         - `subtrees`: the non-leaf nodes in preorder, whose indices are the
+           node indices of the constituency graph;
+         - `subtree_indices`: maps the id of each subtree to its index (so
+           the tables must not outlive the tree objects; see __getstate__);
+         - `preterminals`: the node just above each leaf, in order.
+        '''
+        def __init__(self, tree):
+            self.tree_id = id(tree) # to check we're still on the same tree
+            self.treepositions = tree.treepositions()
+            self.subtrees = list(tree.subtrees())
+            # IDs allow quick checks for identity, rather than expensive
+            # recursive equality checks.
+            self.subtree_indices = {id(subtree): i for i, subtree
+                                    in enumerate(self.subtrees)}
+            self.preterminals = [tree[position[:-1]] for position
+                                 in tree.treepositions('leaves')]
+
+    def get_constituency_tables(self):
+        '''
+        Returns the `ConstituencyTables` for the sentence's constituency tree,
+        building them the first time they're requested.
+        '''
+        if (self._constituency_tables is None
+            or self._constituency_tables.tree_id != id(self.constituency_tree)):
+            self._constituency_tables = self.ConstituencyTables(
+                self.constituency_tree)
+        return self._constituency_tables
+
+    def get_constituency_paths(self):
+        '''
+        Returns the all-pairs shortest path costs and predecessors for the
+        (undirected) constituency graph, as returned by scipy's
+        `shortest_path`. These are computed the first time they're requested,
+        so all the instances in a sentence can share them.
+        '''
+        if self._constituency_paths is None:
+            self._constituency_paths = shortest_path(
+                self.constituency_graph, directed=False,
+                return_predecessors=True)
+        return self._constituency_paths
+
     def dep_to_ptb_tree_string(self):
+        '''
+        Returns a PTB-style string representing the dependency graph, in which
+        each node is labeled `lemma_index` and has its incoming edge label and
+        its POS tag as its first two children. The string is memoized on the
+        sentence.
+        '''
+        if self._dep_ptb_tree_string is not None:
+            return self._dep_ptb_tree_string
+
         # Collapsed dependencies can have cycles, so we need to avoid infinite
         # recursion.
         visited = set()
+        parts = ['(ROOT ']
         def convert_node(node, incoming_arc_label):
             # If we've already visited the node before, don't recurse on it --
             # just re-output its own string. In the vast majority of cases,
@@ -61,19 +149,23 @@ class CausewaySentence(StanfordParsedSentence):
             recurse = node not in visited
             visited.add(node)
             lemma = self.escape_token_text(node.lemma)
-            node_str = '(%s_%d %s %s' % (lemma, node.index,
-                                         incoming_arc_label, node.pos)
-
-            for child_arc_label, child in sorted(
-                self.get_children(node),
-                key=lambda pair: pair[1].start_offset):
-                if recurse and child_arc_label != 'ref':
-                    node_str += ' ' + convert_node(child, child_arc_label)
-            node_str += ')'
-            return node_str
-
-        return '(ROOT %s)' % convert_node(
-            self.get_children(self.tokens[0], 'root')[0], 'root')
+            parts.append('(%s_%d %s %s' % (lemma, node.index,
+                                           incoming_arc_label, node.pos))
+            # Each node's children are only fetched and sorted the one time we
+            # recurse on it.
+            if recurse:
+                for child_arc_label, child in sorted(
+                    self.get_children(node),
+                    key=lambda pair: pair[1].start_offset):
+                    if child_arc_label != 'ref':
+                        parts.append(' ')
+                        convert_node(child, child_arc_label)
+            parts.append(')')
+
+        convert_node(self.get_children(self.tokens[0], 'root')[0], 'root')
+        parts.append(')')
+        self._dep_ptb_tree_string = ''.join(parts)
+        return self._dep_ptb_tree_string
 
     def substitute_dep_ptb_graph(self, ptb_str):
         '''
@@ -87,37 +179,63 @@ class CausewaySentence(StanfordParsedSentence):
         new_sentence = self.shallow_copy_with_sentences_fixed(self)
         new_sentence.edge_graph = edge_graph
         new_sentence.edge_labels = edge_labels
+        new_sentence._dep_ptb_tree_string = None # the graph has changed
         new_sentence._initialize_graph(excluded_edges)
         return new_sentence
 
+    _PTB_TOKEN_RE = re.compile(r'\(|\)|[^\s()]+')
+
     @staticmethod
     def _sentence_graph_from_ptb_str(ptb_str, num_tokens):
         # We need to have num_tokens provided here, or else we won't know for
         # sure how big the graph should be. (There can be tokens missing from
         # the graph, and even if there aren't it would take more processing
         # than it's worth to find the max node index in the PTB tree.)
-        tree = ImmutableParentedTree.fromstring(ptb_str)
-        edge_graph = lil_matrix((num_tokens, num_tokens), dtype='float')
+        edge_starts = []
+        edge_ends = []
         edge_labels = {}
         excluded_edges = []
 
-        def convert_node(parent_index, node):
-            # Node index is whatever's after the last underscore.
-            node_label = node.label()
-            node_index = int(node_label[node_label.rindex('_') + 1:])
-            edge_label = node[0]  # 0th child is always edge label
-            if edge_label in StanfordParsedSentence.DEPTH_EXCLUDED_EDGE_LABELS:
-                excluded_edges.append((parent_index, node_index))
-            else:
-                edge_graph[parent_index, node_index] = 1.0
-            edge_labels[parent_index, node_index] = edge_label
-
-            for child in node[2:]: # Skip edge label (child 0) & POS (child 1).
-                convert_node(node_index, child)
-
-        for root_child in tree:
-            convert_node(0, root_child) # initial parent index is 0 for root
-        return edge_graph.tocsr(), edge_labels, excluded_edges
+        # Rather than building an NLTK tree, we just scan the tokens of the
+        # string. Each open node is a [node index, number of leaves seen] pair;
+        # the root node stands for token 0.
+        open_nodes = []
+        label_pending = False # we've seen a '(', but not yet its label
+        for token in CausewaySentence._PTB_TOKEN_RE.findall(ptb_str):
+            if token == '(':
+                if label_pending: # unlabeled root, as in "( (...))"
+                    open_nodes.append([0, 0])
+                label_pending = True
+            elif token == ')':
+                open_nodes.pop()
+            elif label_pending:
+                label_pending = False
+                if not open_nodes:
+                    open_nodes.append([0, 0])
+                else:
+                    # Node index is whatever's after the last underscore.
+                    node_index = int(token[token.rindex('_') + 1:])
+                    open_nodes.append([node_index, 0])
+            else: # leaf
+                node = open_nodes[-1]
+                node[1] += 1
+                if node[1] == 1: # 0th child is always edge label
+                    edge = (open_nodes[-2][0], node[0])
+                    if (token in
+                        StanfordParsedSentence.DEPTH_EXCLUDED_EDGE_LABELS):
+                        excluded_edges.append(edge)
+                    else:
+                        edge_starts.append(edge[0])
+                        edge_ends.append(edge[1])
+                    edge_labels[edge] = token
+
+        edge_graph = coo_matrix(
+            (np.ones(len(edge_starts)), (edge_starts, edge_ends)),
+            shape=(num_tokens, num_tokens), dtype='float').tocsr()
+        # Nodes that got duplicated in the tree give duplicate edges, which
+        # the conversion to CSR summed.
+        edge_graph.data.fill(1.0)
+        return edge_graph, edge_labels, excluded_edges
 
     def get_auxiliaries_string(self, head):
         # If it's not a copular construction and it's a noun phrase, the whole
@@ -341,26 +459,114 @@ class CausalityStandoffReader(DocumentReader):
     '''
     FILE_PATTERN = r'.*\.ann$'
 
+    # Bump this whenever reading changes in a way that would make previously
+    # cached documents wrong.
+    _CACHE_VERSION = 1
+    # Reader flags that don't affect the contents of a document
+    _CACHE_IRRELEVANT_FLAGS = ['reader_cache_dir', 'reader_recurse',
+                               'reader_processes']
+
     def __init__(self, filepath=None):
         self.sentence_reader = CausewaySentenceReader()
+        self._cache_path = None
+        self._cache_header = None
+        self._using_cache = False
+        self._cached_document = None
         super(CausalityStandoffReader, self).__init__(filepath)
 
     def open(self, filepath):
         super(CausalityStandoffReader, self).open(filepath)
         base_path, _ = os.path.splitext(filepath)
-        self.sentence_reader.open(base_path + '.txt')
+        self._using_cache = False
+        if FLAGS.reader_cache_dir:
+            self._cache_path, self._cache_header = self._get_cache_info(
+                filepath, base_path)
+            self._cached_document = self._load_cached_document()
+            self._using_cache = self._cached_document is not None
+        if not self._using_cache:
+            self.sentence_reader.open(base_path + '.txt')
 
     def close(self):
         super(CausalityStandoffReader, self).close()
         # self.sentence_reader gets closed immediately after opening, so we
         # don't need to bother closing it again.
-        self.sentence_reader.close()
+        if not self._using_cache:
+            self.sentence_reader.close()
+        self._cached_document = None
+
+    def _get_cache_info(self, filepath, base_path):
+        '''
+        Returns the path of the cache file for the document at `filepath`, and
+        the header that the cache file must start with to be valid. The header
+        records the cache version, the reader flags, and the modification time
+        and size of each of the document's source files (the .ann, .txt, .parse,
+        etc. files that share its base name).
+        '''
+        source_stamps = []
+        for source_path in sorted(glob.glob(base_path + '.*')):
+            source_stat = os.stat(source_path)
+            source_stamps.append((path.basename(source_path),
+                                  source_stat.st_mtime, source_stat.st_size))
+        reader_flags = sorted(
+            (name, value) for name, value in FLAGS.FlagValuesDict().iteritems()
+            if name.startswith('reader_')
+            and name not in self._CACHE_IRRELEVANT_FLAGS)
+        header = (self._CACHE_VERSION, reader_flags, source_stamps)
+
+        path_hash = hashlib.sha1(path.abspath(filepath)).hexdigest()
+        return (path.join(FLAGS.reader_cache_dir, path_hash + '.pkl'), header)
+
+    def _load_cached_document(self):
+        try:
+            with open(self._cache_path, 'rb') as cache_file:
+                if cPickle.load(cache_file) != self._cache_header:
+                    return None # stale
+                return cPickle.load(cache_file)
+        except IOError: # not cached yet
+            return None
+        except Exception as e:
+            logging.warn('Ignoring unreadable document cache file %s: %s',
+                         self._cache_path, e)
+            return None
+
+    def _save_cached_document(self, document):
+        if not path.isdir(FLAGS.reader_cache_dir):
+            try:
+                os.makedirs(FLAGS.reader_cache_dir)
+            except OSError:
+                if not path.isdir(FLAGS.reader_cache_dir):
+                    raise
+        # Write to a temporary file and rename it, so that a concurrent run
+        # never sees a partially written cache file.
+        temp_path = '%s.%d.tmp' % (self._cache_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as cache_file:
+                cPickle.dump(self._cache_header, cache_file,
+                             cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(document, cache_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self._cache_path)
+        except (cPickle.PicklingError, TypeError, RuntimeError, IOError) as e:
+            logging.warn('Could not cache document %s: %s',
+                         self._file_stream.name, e)
+            if path.exists(temp_path):
+                os.unlink(temp_path)
 
     def get_next(self):
+        if self._using_cache:
+            # The cached document is returned just once, like the document
+            # the sentence reader would have returned.
+            document, self._cached_document = self._cached_document, None
+            return document
+
         document = self.sentence_reader.get_next()
         if not document:
             return None
+        self.__read_annotations(document)
+        if FLAGS.reader_cache_dir:
+            self._save_cached_document(document)
+        return document
 
+    def __read_annotations(self, document):
         lines = self._file_stream.readlines()
         if not lines:
             logging.warn("No annotations found in file %s"
@@ -391,8 +597,6 @@ class CausalityStandoffReader(DocumentReader):
                             "No relation type for non-causal instance %s (%s)",
                             ovl_instance.id, stringify_connective(ovl_instance))
 
-        return document
-
     @staticmethod
     def __raise_warning_if(condition, message):
         if condition:
@@ -802,6 +1006,126 @@ class CausalityStandoffReader(DocumentReader):
         return result
 
 
+# The reader used by ParallelDirectoryReader's worker processes, which inherit
+# it when they're forked.
+_pool_base_reader = None
+
+def _read_file_documents(reader, file_path):
+    reader.open(file_path)
+    try:
+        documents = []
+        document = reader.get_next()
+        while document:
+            documents.append(document)
+            document = reader.get_next()
+        return documents
+    finally:
+        reader.close()
+
+def _read_documents_for_pool(file_path):
+    '''
+    Returns the pickled documents from `file_path`, or None if they can't be
+    pickled. (If the pool had to pickle them, a failure would kill the worker,
+    and the pool would wait for its result forever.)
+    '''
+    documents = _read_file_documents(_pool_base_reader, file_path)
+    try:
+        return cPickle.dumps(documents, cPickle.HIGHEST_PROTOCOL)
+    except (cPickle.PicklingError, TypeError, RuntimeError) as e:
+        logging.warn('Could not pickle documents from %s: %s', file_path, e)
+        return None
+
+
+class ParallelDirectoryReader(DirectoryReader):
+    '''
+    A DirectoryReader that reads the matching files in a directory with a pool
+    of worker processes, each with its own copy of the base reader. Documents
+    are returned in order of their files' paths (sorted, with the files in
+    each directory coming before those in its subdirectories), so the results
+    don't depend on which worker finishes first.
+    '''
+
+    def __init__(self, file_regexes, base_reader, recurse=False,
+                 num_processes=None):
+        super(ParallelDirectoryReader, self).__init__(file_regexes, base_reader,
+                                                      recurse)
+        self._file_regexes = [re.compile(regex) for regex in file_regexes]
+        self._base_reader = base_reader
+        self._recurse = recurse
+        self._num_processes = num_processes or multiprocessing.cpu_count()
+        self._documents = []
+
+    def open(self, dirpath):
+        global _pool_base_reader
+        self.close()
+        file_paths = self._find_file_paths(dirpath)
+        logging.info('Reading %d files from %s with %d processes',
+                     len(file_paths), dirpath, self._num_processes)
+        _pool_base_reader = self._base_reader
+        pool = multiprocessing.Pool(self._num_processes)
+        try:
+            # imap returns results in order, and a chunk size of 1 keeps the
+            # load balanced when some files are much bigger than others.
+            for i, pickled_documents in enumerate(pool.imap(
+                    _read_documents_for_pool, file_paths, 1)):
+                if pickled_documents is None:
+                    # The worker couldn't send us its documents (see
+                    # _save_cached_document), so read the file here instead.
+                    logging.warn('Reading %s in the main process instead',
+                                 file_paths[i])
+                    file_documents = _read_file_documents(self._base_reader,
+                                                          file_paths[i])
+                else:
+                    file_documents = cPickle.loads(pickled_documents)
+                self._documents.extend(file_documents)
+        finally:
+            pool.terminate()
+            pool.join()
+            _pool_base_reader = None
+        self._documents.reverse() # so get_next can pop from the end
+
+    def _find_file_paths(self, dirpath):
+        if path.isfile(dirpath):
+            return [dirpath]
+        file_paths = []
+        for subdir_path, subdir_names, file_names in os.walk(dirpath):
+            file_paths.extend(
+                path.join(subdir_path, file_name)
+                for file_name in sorted(file_names)
+                if any(regex.match(file_name)
+                       for regex in self._file_regexes))
+            if self._recurse:
+                subdir_names.sort() # os.walk visits them in this order
+            else:
+                del subdir_names[:]
+        return file_paths
+
+    def get_next(self):
+        if self._documents:
+            return self._documents.pop()
+        return None
+
+    def get_all(self):
+        documents = self._documents[::-1]
+        self._documents = []
+        return documents
+
+    def close(self):
+        self._documents = []
+
+
+def make_directory_reader(file_regexes, base_reader, recurse=False):
+    '''
+    Returns a DirectoryReader, which reads in parallel if the reader_processes
+    flag asks for more than one process.
+    '''
+    if FLAGS.reader_processes > 1:
+        return ParallelDirectoryReader(file_regexes, base_reader, recurse,
+                                       FLAGS.reader_processes)
+    else:
+        return DirectoryReader(file_regexes, base_reader, recurse)
+
+
 class CausalityStandoffWriter(InstancesDocumentWriter):
     def __init__(self, filepath=None, initial_char_offset=0):
         super(CausalityStandoffWriter, self).__init__(filepath)
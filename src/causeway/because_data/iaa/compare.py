@@ -8,9 +8,9 @@ import itertools
 import logging
 import sys
 
-from causeway.because_data import CausalityStandoffReader
+from causeway.because_data import (CausalityStandoffReader,
+                                   make_directory_reader)
 from causeway.because_data.iaa import CausalityMetrics, print_indented
-from nlpypline.data.io import DirectoryReader
 
 
 try:
@@ -92,8 +92,8 @@ def main(argv):
         level=logging.WARN)
     logging.captureWarnings(True)
 
-    reader = DirectoryReader(FLAGS.iaa_file_regexes, CausalityStandoffReader(),
-                             FLAGS.iaa_recurse)
+    reader = make_directory_reader(FLAGS.iaa_file_regexes,
+                                   CausalityStandoffReader(), FLAGS.iaa_recurse)
     instances_by_path = []
     for path in iaa_paths:
         reader.open(path)
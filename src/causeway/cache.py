@@ -0,0 +1,279 @@
+'''
+Persistent caches for expensive intermediate results (e.g., TRegex output).
+'''
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+from os import path
+import random
+import sqlite3
+import threading
+import time
+
+
+class DiskCache(object):
+    '''
+    A persistent, size-bounded key/value store, backed by a single SQLite
+    database file. Keys are strings (normally produced by `make_key`); values
+    are byte strings. Once the total size of the stored values exceeds
+    `max_bytes`, entries are evicted in least-recently-used order.
+
+    Recording every read would make each lookup a write, and writes are
+    serialized across all processes using the database. So an entry's
+    last-used time is only updated when it is read more than `touch_interval`
+    seconds after the time last recorded. Eviction order is therefore only
+    accurate to within that interval.
+
+    Instances may be shared between threads, and any number of processes may
+    use the same database file at once. SQLite's transactions ensure that no
+    process ever sees a partially written entry; in addition, processes can
+    use `lock_entries` to wait for entries that another process is in the
+    middle of computing, rather than computing them again.
+    '''
+
+    # When evicting, free up enough space to get down to this fraction of the
+    # maximum size, so that we don't have to evict again on every insertion.
+    _EVICTION_TARGET = 0.9
+    # SQLite limits the number of variables allowed in a single query.
+    _MAX_QUERY_VARS = 500
+    # How long to wait for another process to finish writing before giving up.
+    _BUSY_TIMEOUT_SECONDS = 600
+
+    def __init__(self, db_path, max_bytes=None, touch_interval=600):
+        db_dir = path.dirname(db_path)
+        if db_dir and not path.isdir(db_dir):
+            try:
+                os.makedirs(db_dir)
+            except OSError:
+                if not path.isdir(db_dir):
+                    raise
+
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Transactions are started explicitly (see _transaction).
+        self._connection = sqlite3.connect(
+            db_path, timeout=self._BUSY_TIMEOUT_SECONDS,
+            isolation_level=None, check_same_thread=False)
+        self._connection.text_factory = str
+        # Write-ahead logging lets readers proceed while another process is
+        # writing.
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # Entry locks are byte-range locks on a single file, so there's no need
+        # for a file per entry.
+        self._entry_lock_file = open(db_path + '.locks', 'a')
+        # Creating the tables takes the write lock, so skip it when they
+        # already exist rather than waiting for other processes' writes.
+        if not self._connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table'"
+                " AND name = 'totals'").fetchone():
+            with self._transaction():
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS entries ('
+                    ' key TEXT PRIMARY KEY, value BLOB NOT NULL,'
+                    ' size INTEGER NOT NULL, last_used REAL NOT NULL)')
+                self._connection.execute(
+                    'CREATE INDEX IF NOT EXISTS entries_by_last_used'
+                    ' ON entries (last_used)')
+                # The total size is stored rather than recomputed, since summing
+                # over millions of entries on every insertion would be slow.
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY,'
+                    ' value INTEGER NOT NULL)')
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO totals VALUES ('size',"
+                    " (SELECT COALESCE(SUM(size), 0) FROM entries))")
+
+    @contextmanager
+    def _transaction(self):
+        # Taking the write lock up front means that a transaction never has to
+        # upgrade from a read lock, which can fail if another process is
+        # writing at the same time.
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except:
+            self._connection.rollback()
+            raise
+        else:
+            self._connection.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        '''
+        Returns a stable key identifying the sequence of strings `parts`: the
+        hex SHA-1 digest of their UTF-8 encodings. (Unlike Python's `hash`, this
+        does not vary between platforms or Python versions.)
+        '''
+        key_hash = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            # Length prefixes keep ('ab', 'c') distinct from ('a', 'bc').
+            key_hash.update('%d:' % len(part))
+            key_hash.update(part)
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        '''
+        Returns the value stored for `key`, or None if there isn't one.
+        '''
+        return self.get_many([key]).get(key, None)
+
+    def get_many(self, keys):
+        '''
+        Returns a dictionary mapping each key in `keys` that has a value in the
+        cache to that value.
+        '''
+        keys = list(set(keys))
+        found = {}
+        with self._lock:
+            # Plain reads don't need the write lock; with WAL, they can run
+            # while other processes write.
+            now = time.time()
+            stale_keys = []
+            for start in range(0, len(keys), self._MAX_QUERY_VARS):
+                batch = keys[start:start + self._MAX_QUERY_VARS]
+                for key, value, last_used in self._connection.execute(
+                        'SELECT key, value, last_used FROM entries'
+                        ' WHERE key IN (%s)' % ','.join('?' * len(batch)),
+                        batch):
+                    found[key] = value
+                    if now - last_used > self.touch_interval:
+                        stale_keys.append(key)
+
+            if stale_keys:
+                with self._transaction():
+                    for start in range(0, len(stale_keys),
+                                       self._MAX_QUERY_VARS):
+                        batch = stale_keys[start:start + self._MAX_QUERY_VARS]
+                        self._connection.execute(
+                            'UPDATE entries SET last_used = ? WHERE key IN (%s)'
+                            % ','.join('?' * len(batch)), [now] + batch)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return {key: str(value) for key, value in found.iteritems()}
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        '''
+        Stores each (key, value) pair in `items`, replacing any existing values
+        for those keys, and then evicts old entries if the cache is too large.
+        '''
+        with self._lock:
+            with self._transaction():
+                now = time.time()
+                size_change = 0
+                for key, value in items:
+                    old_size = self._connection.execute(
+                        'SELECT size FROM entries WHERE key = ?',
+                        (key,)).fetchone()
+                    if old_size is not None:
+                        size_change -= old_size[0]
+                    self._connection.execute(
+                        'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                        (key, sqlite3.Binary(value), len(value), now))
+                    size_change += len(value)
+                self._connection.execute(
+                    "UPDATE totals SET value = value + ? WHERE name = 'size'",
+                    (size_change,))
+                self._evict_if_needed()
+
+    def lock_entries(self, keys):
+        '''
+        Takes advisory locks on the entries for `keys`, first waiting for any
+        other process holding a lock on any of them to release it. A process
+        that's about to compute some entries should lock them, re-check the
+        cache for entries another process finished while it waited, and unlock
+        them (with `unlock_entries`) once it has stored the results.
+
+        The locks are POSIX record locks, which belong to the process as a
+        whole, so they only coordinate between processes, not threads.
+        '''
+        offsets = self._get_lock_offsets(keys)
+        while True:
+            locked_offsets = []
+            try:
+                # Locking in sorted order keeps processes with overlapping sets
+                # of keys from deadlocking.
+                for offset in offsets:
+                    fcntl.lockf(self._entry_lock_file, fcntl.LOCK_EX, 1,
+                                offset)
+                    locked_offsets.append(offset)
+                return
+            except IOError as e:
+                self._unlock_offsets(locked_offsets)
+                # The kernel's deadlock detection can give false positives
+                # when processes have multiple threads; just try again.
+                if e.errno != errno.EDEADLK:
+                    raise
+                time.sleep(random.uniform(0.1, 1.0))
+
+    def unlock_entries(self, keys):
+        self._unlock_offsets(self._get_lock_offsets(keys))
+
+    def _unlock_offsets(self, offsets):
+        for offset in offsets:
+            fcntl.lockf(self._entry_lock_file, fcntl.LOCK_UN, 1, offset)
+
+    @staticmethod
+    def _get_lock_offsets(keys):
+        # The byte of the lock file that stands for each key. 60 bits of the
+        # key's hash make collisions vanishingly unlikely while staying within
+        # the range of file offsets.
+        return sorted(set(int(hashlib.sha1(key).hexdigest()[:15], 16)
+                          for key in keys))
+
+    def _evict_if_needed(self):
+        # Assumes the lock is held and a transaction is open.
+        if self.max_bytes is None:
+            return
+        total_size = self.get_total_size()
+        if total_size <= self.max_bytes:
+            return
+
+        bytes_to_free = total_size - int(self.max_bytes * self._EVICTION_TARGET)
+        freed = 0
+        keys_to_evict = []
+        for key, size in self._connection.execute(
+                'SELECT key, size FROM entries ORDER BY last_used'):
+            if freed >= bytes_to_free:
+                break
+            keys_to_evict.append(key)
+            freed += size
+        for start in range(0, len(keys_to_evict), self._MAX_QUERY_VARS):
+            batch = keys_to_evict[start:start + self._MAX_QUERY_VARS]
+            self._connection.execute(
+                'DELETE FROM entries WHERE key IN (%s)'
+                % ','.join('?' * len(batch)), batch)
+        self._connection.execute(
+            "UPDATE totals SET value = value - ? WHERE name = 'size'",
+            (freed,))
+        self.evictions += len(keys_to_evict)
+        logging.debug('Evicted %d entries (%d bytes) from cache %s',
+                      len(keys_to_evict), freed, self.db_path)
+
+    def get_total_size(self):
+        return self._connection.execute(
+            "SELECT value FROM totals WHERE name = 'size'").fetchone()[0]
+
+    def get_stats_string(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / float(lookups) if lookups else 0.0
+        return ('%d hits, %d misses (%0.1f%% hit rate), %d evictions'
+                % (self.hits, self.misses, hit_rate * 100, self.evictions))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+            self._entry_lock_file.close()
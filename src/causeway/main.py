@@ -18,12 +18,12 @@ from causeway.baseline.combiner import BaselineCombinerStage
 from causeway.baseline.most_freq_filter import MostFreqSenseFilterStage
 from causeway.candidate_filter import (CausationPatternFilterStage,
                                        CausalClassifierModel)
-from causeway.because_data import CausalityStandoffReader
+from causeway.because_data import (CausalityStandoffReader,
+                                   make_directory_reader)
 from causeway.regex_based.crf_stage import ArgumentLabelerStage
 from causeway.regex_based.regex_stage import RegexConnectiveStage
 from causeway.tregex_based.arg_span_stage import ArgSpanStage
 from causeway.tregex_based.tregex_stage import TRegexConnectiveStage
-from nlpypline.data.io import DirectoryReader
 from nlpypline.pipeline import Pipeline, SimpleStage
 from nlpypline.pipeline.models import ClassBalancingClassifierWrapper
 from nlpypline.util import print_indented
@@ -176,9 +176,9 @@ if __name__ == '__main__':
     stages = get_stages(candidate_classifier)
 
     causality_pipeline = Pipeline(
-        stages, DirectoryReader((CausalityStandoffReader.FILE_PATTERN,),
-                                CausalityStandoffReader(),
-                                FLAGS.reader_recurse))
+        stages, make_directory_reader((CausalityStandoffReader.FILE_PATTERN,),
+                                      CausalityStandoffReader(),
+                                      FLAGS.reader_recurse))
 
     if FLAGS.eval_with_cv:
         eval_results = causality_pipeline.cross_validate()
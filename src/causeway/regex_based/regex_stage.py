@@ -4,7 +4,7 @@ import logging
 import re
 import time
 
-from causeway import PossibleCausation, PairwiseAndNonIAAEvaluator
+from causeway import PossibleCausation, PairwiseAndNonIAAEvaluator, LemmaIndex
 from nlpypline.pipeline import Stage
 from nlpypline.pipeline.models import Model
 from nlpypline.util import Enum
@@ -24,13 +24,16 @@ class RegexConnectiveModel(Model):
 
     def _train_model(self, sentences):
         self.regexes = [
-            (re.compile(pattern), matching_groups)
-            for pattern, matching_groups in self._extract_patterns(sentences)]
+            (re.compile(pattern), matching_groups, connective_lemmas)
+            for pattern, matching_groups, connective_lemmas
+            in self._extract_patterns(sentences)]
 
     def test(self, sentences):
         logging.info('Tagging possible connectives...')
         start_time = time.time()
 
+        strings_to_match = []
+        all_token_bounds = []
         for sentence in sentences:
             sentence.possible_causations = []
 
@@ -49,11 +52,20 @@ class RegexConnectiveModel(Model):
             for lemma in lemmas_to_match:
                 token_bounds.append((next_start, next_start + len(lemma)))
                 next_start += len(lemma) + 1
-
-            # More than one pattern may match a given connective. We record
-            # which patterns matched which sets of connective words.
-            matches = defaultdict(list)
-            for regex, matching_group_indices in self.regexes:
+            strings_to_match.append(string_to_match)
+            all_token_bounds.append(token_bounds)
+
+        # More than one pattern may match a given connective. For each sentence,
+        # we record which patterns matched which sets of connective words.
+        all_matches = [defaultdict(list) for _ in sentences]
+        # Only search sentences that contain all of a regex's connective words.
+        lemma_index = LemmaIndex(sentences)
+        for regex, matching_group_indices, connective_lemmas in self.regexes:
+            for sentence_index in lemma_index.get_sentence_indices(
+                    connective_lemmas):
+                string_to_match = strings_to_match[sentence_index]
+                token_bounds = all_token_bounds[sentence_index]
+                matches = all_matches[sentence_index]
                 match = regex.search(string_to_match)
                 while match is not None:
                     # We need to add 1 to indices to account for root.
@@ -67,6 +79,7 @@ class RegexConnectiveModel(Model):
                     # pattern start group.)
                     match = regex.search(string_to_match, pos=match.span(2)[1])
 
+        for sentence, matches in zip(sentences, all_matches):
             for token_indices, matching_patterns in matches.items():
                 connective_tokens = [sentence.tokens[i] for i in token_indices]
                 true_causation_instance = None
@@ -83,23 +96,6 @@ class RegexConnectiveModel(Model):
         logging.info("Done tagging possible connectives in %0.2f seconds"
                      % elapsed_seconds)
 
-    #####################################
-    # Sentence preprocessing
-    #####################################
-
-    @staticmethod
-    def _filter_sentences_for_pattern(sentences, pattern, connective_lemmas):
-        possible_sentence_indices = []
-        for i, sentence in enumerate(sentences):
-            token_lemmas = [token.lemma for token in sentence.tokens]
-            # TODO: Should we filter here by whether there are enough tokens in
-            # the sentence to match the rest of the pattern, too?
-            if all([connective_lemma in token_lemmas
-                    for connective_lemma in connective_lemmas]):
-                possible_sentence_indices.append(i)
-
-        return possible_sentence_indices
-
     #####################################
     # Pattern generation
     #####################################
@@ -184,8 +180,9 @@ class RegexConnectiveModel(Model):
                             'utf-8')
                         print
                     patterns_seen.add(pattern)
-                    regex_patterns.append((pattern,
-                                           connective_capturing_groups))
+                    connective_lemmas = [t.lemma for t in connective]
+                    regex_patterns.append((pattern, connective_capturing_groups,
+                                           connective_lemmas))
         return regex_patterns
 
 
@@ -0,0 +1,574 @@
+'''
+An in-process matcher for the small subset of TRegex syntax that the
+dependency-mode pattern generator produces. Matching happens directly on the
+preprocessed PTB-style trees that TRegex would otherwise be given, and the
+output reproduces the output of `tregex.sh -o -l -N -h ...`, so the results
+can be consumed exactly as TRegex's would be.
+
+Supported syntax:
+ - node descriptions: `/regex/`, `__`, bare labels, `=name` back-references,
+   `~name` description references, and `=name` node names;
+ - relations: `<`, `>`, `<i` (i-th child), and `==`, optionally negated with
+   `!`;
+ - relation alternations (`[rel1 | rel2 ...]`), parentheses, and `:`-separated
+   pattern segments.
+
+Anything else raises an `UnsupportedPatternError`, and should be handed to
+TRegex itself.
+
+Patterns that differ only in the edge labels allowed by their `[<1 label1 |
+<1 label2 ...]` alternations (and in the names of their non-handle nodes) can
+be merged into a single matcher, which finds the matches for all of them in one
+search.
+'''
+
+import re
+
+
+class UnsupportedPatternError(ValueError):
+    pass
+
+
+class PTBTree(object):
+    '''
+    A tree read from a PTB-style string. Nodes (including leaves) are
+    numbered in preorder, which is the order in which TRegex visits them, and
+    the tree is stored as flat per-node lists.
+    '''
+    __slots__ = ['labels', 'parents', 'children']
+    _TOKEN_RE = re.compile(r'\(|\)|[^\s()]+', re.UNICODE)
+
+    def __init__(self, ptb_string):
+        if isinstance(ptb_string, str):
+            ptb_string = ptb_string.decode('utf-8')
+        self.labels = []
+        self.parents = []
+        self.children = []
+
+        open_nodes = []
+        label_pending = False # we've seen a '(', but not yet its label
+        for token in self._TOKEN_RE.findall(ptb_string):
+            if token == '(':
+                if label_pending: # the last node had no label
+                    open_nodes.append(self._add_node('', open_nodes))
+                label_pending = True
+            elif token == ')':
+                if label_pending:
+                    self._add_node('', open_nodes)
+                    label_pending = False
+                elif open_nodes:
+                    open_nodes.pop()
+            elif label_pending:
+                open_nodes.append(self._add_node(token, open_nodes))
+                label_pending = False
+            else: # leaf
+                self._add_node(token, open_nodes)
+
+    def _add_node(self, label, open_nodes):
+        node = len(self.labels)
+        parent = open_nodes[-1] if open_nodes else None
+        self.labels.append(label)
+        self.parents.append(parent)
+        self.children.append([])
+        if parent is not None:
+            self.children[parent].append(node)
+        return node
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class DependencyPatternMatcher(object):
+    '''
+    A compiled pattern, whose matches are reported as the nodes matching
+    `handles`. Raises `UnsupportedPatternError` on construction if the pattern
+    uses syntax outside the supported subset.
+    '''
+
+    # Node description kinds
+    _ANY = 0
+    _REGEX = 1
+    _EXACT = 2
+    _BACKREF = 3
+
+    # Relation kinds
+    _CHILD = 0
+    _PARENT = 1
+    _ITH_CHILD = 2
+    _SAME = 3
+    _ALTERNATION = 4
+    _FIRST_CHILD_LABEL = 5 # an alternation of `<1 label` relations
+
+    _TOKEN_RE = re.compile(r'''
+        \s*(?:
+          (?P<regex>/(?:[^/\\]|\\.)*/)
+          | (?P<relation>[<>][^\s()\[\]/=!~|:]*|==)
+          | (?P<punct>[()\[\]|:=~!])
+          | (?P<ident>[^\s()\[\]|/=!<>~:@#%&?$,;{}]
+                      [^\s()\[\]|/=!<>~@#%&?$,;{}]*)
+        )''', re.VERBOSE | re.UNICODE)
+
+    class _Node(object):
+        __slots__ = ['kind', 'value', 'name', 'relations']
+
+        def __init__(self, kind, value, name=None):
+            self.kind = kind
+            self.value = value
+            self.name = name
+            self.relations = []
+
+    class _Relation(object):
+        __slots__ = ['kind', 'arg', 'child_index', 'negated']
+
+        def __init__(self, kind, arg, child_index=None):
+            # arg is the target node; for alternations, a list of alternative
+            # relation lists; or, for first-child label tests, a dictionary
+            # mapping each allowed label to the mask of the merged patterns
+            # that allow it.
+            self.kind = kind
+            self.arg = arg
+            self.child_index = child_index
+            self.negated = False
+
+    def __init__(self, pattern, handles):
+        self.pattern = pattern
+        self.patterns = [pattern] # the original patterns, if merged
+        self.handles = handles
+        self._tokens = self._tokenize(pattern)
+        self._position = 0
+        self._declared = {} # node name -> (description kind, value)
+        self._in_restricted_context = False # inside a negation/alternation
+
+        self.segments = [self._parse_segment()]
+        while self._accept(':'):
+            self.segments.append(self._parse_segment())
+        if self._position != len(self._tokens):
+            self._fail('unexpected %s' % self._tokens[self._position][1])
+
+        del self._tokens
+        for handle in handles:
+            if handle not in self._declared:
+                self._fail('undeclared handle %s' % handle)
+
+    def match(self, tree):
+        '''
+        Returns the lines TRegex would output for `tree` (not including the
+        tree number line or the terminating blank line): for each node at
+        which the pattern matches, in preorder, the labels of the nodes
+        matching each handle in the first match rooted there.
+        '''
+        return self.match_all(tree)[0]
+
+    def match_all(self, tree):
+        '''
+        Like `match`, but returns a list of output lines for each of the
+        original patterns of a merged matcher, in the order of `self.patterns`.
+        Each list is exactly what TRegex would output for that pattern alone.
+        '''
+        all_patterns_mask = (1 << len(self.patterns)) - 1
+        lines = [[] for _ in self.patterns]
+        all_nodes = range(len(tree))
+        for root in all_nodes:
+            bindings = {}
+            # We only need the first match for each root (cf. TRegex's -o) for
+            # each pattern. The search visits any one pattern's matches in the
+            # same order as searching for that pattern alone would, so the
+            # first match that satisfies a pattern is the one to report for it.
+            unreported = all_patterns_mask
+            for match_mask in self._match_segments(
+                    tree, 0, [root], all_nodes, bindings, all_patterns_mask):
+                newly_matched = match_mask & unreported
+                if not newly_matched:
+                    continue
+                handle_labels = [
+                    tree.labels[bindings[handle]].encode('utf-8')
+                    for handle in self.handles]
+                for pattern_index, pattern_lines in enumerate(lines):
+                    if newly_matched & (1 << pattern_index):
+                        pattern_lines.extend(handle_labels)
+                unreported &= ~newly_matched
+                if not unreported:
+                    break
+        return lines
+
+    def get_signature(self):
+        '''
+        Returns a string describing the structure of the pattern, ignoring the
+        labels allowed by its `<1 label` alternations and the names of nodes
+        that aren't handles. Matchers with equal signatures and handles can be
+        combined with `merge`.
+        '''
+        canonical_names = {}
+        def get_name(name):
+            if name is None or name in self.handles:
+                return name
+            return canonical_names.setdefault(name,
+                                              '#%d' % len(canonical_names))
+
+        def describe_node(node):
+            if node.kind == self._REGEX:
+                value = node.value.pattern
+            elif node.kind == self._BACKREF:
+                value = get_name(node.value)
+            else:
+                value = node.value
+            parts = ['%d/%s=%s' % (node.kind, value, get_name(node.name))]
+            parts.extend(describe_relation(relation)
+                         for relation in node.relations)
+            return '(%s)' % ' '.join(parts)
+
+        def describe_relation(relation):
+            prefix = '!' if relation.negated else ''
+            if relation.kind == self._FIRST_CHILD_LABEL:
+                return prefix + '<1?'
+            elif relation.kind == self._ALTERNATION:
+                return prefix + '[%s]' % ' | '.join(
+                    ' '.join(describe_relation(r) for r in alternative)
+                    for alternative in relation.arg)
+            return '%s%d/%s %s' % (prefix, relation.kind, relation.child_index,
+                                   describe_node(relation.arg))
+
+        return ' : '.join(describe_node(segment) for segment in self.segments)
+
+    @staticmethod
+    def merge(matchers):
+        '''
+        Returns a single matcher that finds the matches of all the matchers in
+        `matchers`, which must have equal signatures and handles. Its
+        `match_all` results have one entry per merged matcher.
+        '''
+        first = matchers[0]
+        merged = DependencyPatternMatcher(first.pattern, first.handles)
+        merged.patterns = []
+        merged_tests = merged._get_first_child_label_tests()
+        for test in merged_tests:
+            test.arg = {}
+        for matcher in matchers:
+            if (matcher.handles != first.handles
+                or matcher.get_signature() != first.get_signature()):
+                raise ValueError('Cannot merge patterns %s and %s'
+                                 % (first.pattern, matcher.pattern))
+            mask = 1 << len(merged.patterns)
+            merged.patterns.extend(matcher.patterns)
+            for merged_test, test in zip(
+                    merged_tests, matcher._get_first_child_label_tests()):
+                label_masks = merged_test.arg
+                for label in test.arg:
+                    label_masks[label] = label_masks.get(label, 0) | mask
+        return merged
+
+    def _get_first_child_label_tests(self):
+        tests = []
+        def add_node_tests(node):
+            for relation in node.relations:
+                add_relation_tests(relation)
+        def add_relation_tests(relation):
+            if relation.kind == self._FIRST_CHILD_LABEL:
+                tests.append(relation)
+            elif relation.kind == self._ALTERNATION:
+                for alternative in relation.arg:
+                    for alternative_relation in alternative:
+                        add_relation_tests(alternative_relation)
+            else:
+                add_node_tests(relation.arg)
+        for segment in self.segments:
+            add_node_tests(segment)
+        return tests
+
+    #####################################
+    # Parsing
+    #####################################
+
+    def _tokenize(self, pattern):
+        tokens = []
+        position = 0
+        pattern = pattern.rstrip()
+        while position < len(pattern):
+            token_match = self._TOKEN_RE.match(pattern, position)
+            if token_match is None or token_match.end() == position:
+                raise UnsupportedPatternError(
+                    'Unsupported syntax at position %d of pattern %s'
+                    % (position, pattern))
+            tokens.append((token_match.lastgroup,
+                           token_match.group(token_match.lastgroup)))
+            position = token_match.end()
+        return tokens
+
+    def _fail(self, message):
+        raise UnsupportedPatternError('%s in pattern %s'
+                                      % (message, self.pattern))
+
+    def _peek(self):
+        try:
+            return self._tokens[self._position]
+        except IndexError:
+            return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            self._fail('unexpected end')
+        self._position += 1
+        return token
+
+    def _accept(self, punctuation):
+        if self._peek() == ('punct', punctuation):
+            self._position += 1
+            return True
+        return False
+
+    def _expect(self, punctuation):
+        if not self._accept(punctuation):
+            self._fail('expected %s' % punctuation)
+
+    def _parse_segment(self):
+        node = self._parse_node()
+        if self._peek() not in [(None, None), ('punct', ':')]:
+            self._fail('unexpected %s' % self._peek()[1])
+        return node
+
+    def _parse_node(self):
+        if self._accept('('):
+            node = self._parse_node()
+            self._expect(')')
+            return node
+        node = self._parse_description()
+        node.relations = self._parse_relations()
+        return node
+
+    def _parse_description(self):
+        token_type, value = self._next()
+        if (token_type, value) == ('punct', '='):
+            name = self._parse_name()
+            if name not in self._declared:
+                self._fail('undeclared node %s' % name)
+            return self._Node(self._BACKREF, name)
+        elif (token_type, value) == ('punct', '~'):
+            name = self._parse_name()
+            try:
+                kind, description_value = self._declared[name]
+            except KeyError:
+                self._fail('undeclared node %s' % name)
+            return self._Node(kind, description_value)
+
+        if token_type == 'regex':
+            regex_body = value[1:-1].replace('\\/', '/')
+            try:
+                node = self._Node(self._REGEX,
+                                  re.compile(regex_body, re.UNICODE))
+            except re.error:
+                self._fail('unsupported regex %s' % value)
+        elif token_type == 'ident' and value == '__':
+            node = self._Node(self._ANY, None)
+        elif token_type == 'ident':
+            node = self._Node(self._EXACT, value)
+        else:
+            self._fail('unsupported node description %s' % value)
+
+        if self._accept('='):
+            if self._in_restricted_context:
+                self._fail('named node in negation or alternation')
+            name = self._parse_name()
+            if name in self._declared:
+                self._fail('node %s declared twice' % name)
+            node.name = name
+            self._declared[name] = (node.kind, node.value)
+        return node
+
+    def _parse_name(self):
+        token_type, value = self._next()
+        if token_type != 'ident':
+            self._fail('expected a node name')
+        return value
+
+    def _parse_relations(self):
+        relations = []
+        while True:
+            token_type, value = self._peek()
+            if (token_type, value) == ('punct', '['):
+                relations.append(self._parse_alternation())
+            elif (token_type, value) == ('punct', '!'):
+                self._position += 1
+                if self._peek()[0] != 'relation':
+                    self._fail('unsupported negation')
+                was_restricted = self._in_restricted_context
+                self._in_restricted_context = True
+                relation = self._parse_relation()
+                self._in_restricted_context = was_restricted
+                relation.negated = True
+                relations.append(relation)
+            elif token_type == 'relation':
+                relations.append(self._parse_relation())
+            else:
+                return relations
+
+    def _parse_alternation(self):
+        self._expect('[')
+        was_restricted = self._in_restricted_context
+        self._in_restricted_context = True
+        alternatives = []
+        while True:
+            alternative = self._parse_relations()
+            if not alternative:
+                self._fail('empty alternative')
+            alternatives.append(alternative)
+            if self._accept(']'):
+                break
+            self._expect('|')
+        self._in_restricted_context = was_restricted
+
+        # The dependency pattern generator expresses sets of allowed edge
+        # labels as alternations of `<1 label` relations. At most one of those
+        # can hold for any given node, so they amount to a lookup of the first
+        # child's label.
+        if all(len(alternative) == 1 and self._is_first_child_label_test(
+                   alternative[0]) for alternative in alternatives):
+            return self._Relation(
+                self._FIRST_CHILD_LABEL,
+                {alternative[0].arg.value: 1 for alternative in alternatives})
+        return self._Relation(self._ALTERNATION, alternatives)
+
+    def _is_first_child_label_test(self, relation):
+        return (relation.kind == self._ITH_CHILD and relation.child_index == 0
+                and not relation.negated and relation.arg.kind == self._EXACT
+                and not relation.arg.relations)
+
+    def _parse_relation(self):
+        _, operator = self._next()
+        child_index = None
+        if operator == '<':
+            kind = self._CHILD
+        elif operator == '>':
+            kind = self._PARENT
+        elif operator == '==':
+            kind = self._SAME
+        elif operator[0] == '<' and operator[1:].isdigit():
+            kind = self._ITH_CHILD
+            child_index = int(operator[1:]) - 1
+        else:
+            self._fail('unsupported relation %s' % operator)
+
+        if self._accept('('):
+            target = self._parse_node()
+            self._expect(')')
+        else:
+            target = self._parse_description()
+        return self._Relation(kind, target, child_index)
+
+    #####################################
+    # Matching
+    #####################################
+
+    # The match functions below are generators that yield once for each way
+    # they can be satisfied, leaving `bindings` (node name -> node) filled in
+    # for the match while they're suspended. This gives the same
+    # backtracking search order as TRegex, so the first match found for each
+    # root is the one TRegex would report.
+    #
+    # Each function takes a mask of the merged patterns that are still
+    # consistent with the partial match, and yields the (possibly narrower)
+    # mask for each way it's satisfied. Branches are abandoned as soon as no
+    # pattern is left.
+
+    def _match_segments(self, tree, segment_index, candidates, all_nodes,
+                        bindings, mask):
+        # After the first segment, which must match at the root, each
+        # `:`-separated segment can match anywhere in the tree.
+        if segment_index == len(self.segments):
+            yield mask
+            return
+        segment = self.segments[segment_index]
+        for node in candidates:
+            for node_mask in self._match_node(tree, segment, node, bindings,
+                                              mask):
+                for result_mask in self._match_segments(
+                        tree, segment_index + 1, all_nodes, all_nodes,
+                        bindings, node_mask):
+                    yield result_mask
+
+    def _match_node(self, tree, pattern_node, node, bindings, mask):
+        kind = pattern_node.kind
+        if kind == self._REGEX:
+            if not pattern_node.value.search(tree.labels[node]):
+                return
+        elif kind == self._EXACT:
+            if tree.labels[node] != pattern_node.value:
+                return
+        elif kind == self._BACKREF:
+            if bindings.get(pattern_node.value) != node:
+                return
+
+        name = pattern_node.name
+        if name is not None:
+            bindings[name] = node
+        try:
+            for result_mask in self._match_relations(
+                    tree, pattern_node.relations, 0, node, bindings, mask):
+                yield result_mask
+        finally:
+            if name is not None:
+                del bindings[name]
+
+    def _match_relations(self, tree, relations, relation_index, node,
+                         bindings, mask):
+        if relation_index == len(relations):
+            yield mask
+            return
+        for relation_mask in self._match_relation(
+                tree, relations[relation_index], node, bindings, mask):
+            for result_mask in self._match_relations(
+                    tree, relations, relation_index + 1, node, bindings,
+                    relation_mask):
+                yield result_mask
+
+    def _match_relation(self, tree, relation, node, bindings, mask):
+        if relation.negated:
+            # A negated relation holds for the patterns for which the positive
+            # relation can't be satisfied. Names can't be declared under
+            # negation, so it's safe to abandon the search partway through.
+            satisfied_mask = 0
+            for relation_mask in self._match_positive_relation(
+                    tree, relation, node, bindings, mask):
+                satisfied_mask |= relation_mask
+                if satisfied_mask == mask:
+                    return
+            yield mask & ~satisfied_mask
+        else:
+            for relation_mask in self._match_positive_relation(
+                    tree, relation, node, bindings, mask):
+                yield relation_mask
+
+    def _match_positive_relation(self, tree, relation, node, bindings, mask):
+        kind = relation.kind
+        if kind == self._FIRST_CHILD_LABEL:
+            children = tree.children[node]
+            if children:
+                label_mask = mask & relation.arg.get(tree.labels[children[0]],
+                                                     0)
+                if label_mask:
+                    yield label_mask
+            return
+        elif kind == self._ALTERNATION:
+            for alternative in relation.arg:
+                for result_mask in self._match_relations(
+                        tree, alternative, 0, node, bindings, mask):
+                    yield result_mask
+            return
+
+        if kind == self._CHILD:
+            candidates = tree.children[node]
+        elif kind == self._PARENT:
+            parent = tree.parents[node]
+            candidates = [parent] if parent is not None else []
+        elif kind == self._SAME:
+            candidates = [node]
+        else: # i-th child
+            children = tree.children[node]
+            child_index = relation.child_index
+            candidates = ([children[child_index]]
+                          if 0 <= child_index < len(children) else [])
+
+        for candidate in candidates:
+            for result_mask in self._match_node(tree, relation.arg, candidate,
+                                                bindings, mask):
+                yield result_mask
@@ -1,24 +1,32 @@
+from collections import Counter
+import cPickle
+import fcntl
 from gflags import (DEFINE_string, FLAGS, DuplicateFlagError, DEFINE_integer,
-                    DEFINE_enum)
+                    DEFINE_enum, DEFINE_bool, DEFINE_float)
+import hashlib
 import itertools
 import threading
+import json
 import logging
-from math import log10
+import mmap
+import multiprocessing
 from os import path
 import Queue
+import signal
 import subprocess
 import sys
 import tempfile
 import time
-from threading import Lock
 
 from nlpypline.data import Token
 from nlpypline.pipeline import Stage
 from nlpypline.pipeline.models import Model
 from causeway import (PossibleCausation, PairwiseAndNonIAAEvaluator,
-                      get_causation_tuple)
-from nlpypline.util import pairwise, igroup, hash_file
-from nlpypline.util.nltk import subtree_at_index, index_of_subtree
+                      get_causation_tuple, LemmaIndex)
+from causeway.cache import DiskCache
+from causeway.tregex_based.dep_matcher import (
+    DependencyPatternMatcher, PTBTree, UnsupportedPatternError)
+from nlpypline.util import pairwise, igroup
 from nlpypline.util.scipy import steiner_tree, longest_path_in_tree
 import os
 
@@ -32,11 +40,63 @@ try:
         'Maximum number of Steiner nodes to be allowed in TRegex patterns')
     DEFINE_integer('tregex_max_threads', 30,
                    'Max number of TRegex processor threads')
-    DEFINE_integer('tregex_max_cache_filename_len', 255,
-                   'Max filename length to allow for files in the TRegex cache')
+    DEFINE_string('tregex_cache_path',
+                  path.expanduser(path.join('~', 'tregex_cache', 'tregex.db')),
+                  'Path of the database in which to cache TRegex results')
+    DEFINE_integer('tregex_cache_max_mb', 4096,
+                   'Maximum size of the TRegex cache, in MB. Least recently'
+                   ' used entries are evicted beyond this size.')
     DEFINE_enum('tregex_pattern_type', 'dependency',
                 ['dependency', 'constituency'],
                 'Type of tree to generate and run TRegex patterns with')
+    DEFINE_bool('tregex_persistent_workers', True,
+                'Whether to run patterns through long-lived TregexServer'
+                ' processes that load the preprocessed trees only once, rather'
+                ' than launching a new TRegex process for every pattern')
+    DEFINE_integer('tregex_server_workers', 4,
+                   'Max number of persistent TregexServer workers. Each one'
+                   ' holds the whole preprocessed corpus in its own JVM (up to'
+                   ' 1 GB with the standard tregex_server.sh). 0 launches a'
+                   ' new TRegex process for every pattern instead.')
+    DEFINE_bool('tregex_native_matcher', True,
+                'Whether to match dependency-mode patterns in-process where'
+                ' possible, falling back to TRegex only for patterns that use'
+                ' unsupported syntax')
+    DEFINE_integer('tregex_extraction_processes', 1,
+                   'Number of processes to use for extracting patterns from'
+                   ' training sentences')
+    DEFINE_string('tregex_stats_path', '',
+                  'Path of a JSON-lines file to which to append timing and'
+                  ' match statistics for each pattern run. Empty for none.')
+    DEFINE_integer('tregex_timeout', 300,
+                   'Number of seconds TRegex may spend on a single tree before'
+                   ' it is killed and the pattern is quarantined. 0 for no'
+                   ' limit.')
+    DEFINE_string('tregex_quarantine_path',
+                  path.expanduser(path.join('~', 'tregex_cache',
+                                            'quarantine.json')),
+                  'Path of the JSON file recording patterns on which TRegex'
+                  ' has timed out')
+    DEFINE_enum('tregex_quarantine_action', 'split', ['skip', 'split'],
+                'What to do with quarantined patterns: skip them entirely, or'
+                ' split off the sentences TRegex timed out on and run the'
+                ' pattern on the rest')
+    DEFINE_bool('tregex_prune_patterns', False,
+                'Whether to run the extracted patterns on the training data'
+                ' and drop those that fall below the yield thresholds')
+    DEFINE_integer('tregex_prune_min_true_positives', 1,
+                   'Minimum number of correct connectives a pattern must find'
+                   ' in the training data to survive pruning')
+    DEFINE_float('tregex_prune_min_precision', 0.0,
+                 'Minimum precision of connectives found by a pattern in the'
+                 ' training data for it to survive pruning')
+    DEFINE_bool('tregex_cache_writes', True,
+                'Whether to store new TRegex, TSurgeon, and pattern'
+                ' generation results in the cache. (Cached results are still'
+                ' used when this is off.)')
+    DEFINE_bool('tregex_merge_patterns', True,
+                'Whether to run natively matched patterns that differ only in'
+                ' their allowed edge labels as a single merged pattern')
 
 except DuplicateFlagError as e:
     logging.warn('Ignoring flag redefinitions; assuming module reload')
@@ -47,8 +107,16 @@ class TRegexConnectiveModel(Model):
         self.tregex_patterns = []
         # Internal hackery properties, used for training.
         self._ptb_strings = None
+        self._training_outputs = None
         self._num_sentences = None # Poor man's check for same sentences
 
+    def __getstate__(self):
+        # The training hacks hold on to sentences, so don't save them.
+        state = self.__dict__.copy()
+        state['_ptb_strings'] = None
+        state['_training_outputs'] = None
+        return state
+
     def reset(self):
         self.tregex_patterns = []
 
@@ -59,58 +127,211 @@ class TRegexConnectiveModel(Model):
         self._ptb_strings = ptb_strings
         self._num_sentences = len(sentences)
 
+        if FLAGS.tregex_prune_patterns:
+            predicted_outputs = self.test(sentences)
+            # Same hack again: when test() is called on the training data to
+            # provide input to the next stage, just return what we already
+            # have.
+            self._training_outputs = self._prune_patterns(predicted_outputs)
+            self._num_sentences = len(sentences)
+
+    def _prune_patterns(self, predicted_outputs):
+        '''
+        Drops patterns whose yield on the training data, as recorded in
+        `predicted_outputs`, falls below the pruning thresholds. Returns
+        `predicted_outputs` with the dropped patterns' matches removed.
+        '''
+        matches = Counter()
+        true_positives = Counter()
+        for sentence_pcs in predicted_outputs:
+            for pc in sentence_pcs:
+                pattern = pc.matching_patterns[0]
+                matches[pattern] += 1
+                if pc.true_causation_instance is not None:
+                    true_positives[pattern] += 1
+
+        kept_patterns = []
+        dropped_patterns = set()
+        for pattern_tuple in self.tregex_patterns:
+            pattern = pattern_tuple[0]
+            pattern_tps = true_positives[pattern]
+            try:
+                precision = pattern_tps / float(matches[pattern])
+            except ZeroDivisionError:
+                precision = 0.0
+            if (pattern_tps >= FLAGS.tregex_prune_min_true_positives
+                and precision >= FLAGS.tregex_prune_min_precision):
+                kept_patterns.append(pattern_tuple)
+            else:
+                dropped_patterns.add(pattern)
+                logging.info('Pruning pattern (%d of %d matches correct): %s',
+                             pattern_tps, matches[pattern], pattern)
+
+        logging.info('Pruned %d of %d patterns', len(dropped_patterns),
+                     len(self.tregex_patterns))
+        self.tregex_patterns = kept_patterns
+        return [[pc for pc in sentence_pcs
+                 if pc.matching_patterns[0] not in dropped_patterns]
+                for sentence_pcs in predicted_outputs]
+
     def test(self, sentences):
+        if (self._training_outputs is not None
+            and self._num_sentences == len(sentences)):
+            predicted_outputs = self._training_outputs
+            self._training_outputs = None
+            return predicted_outputs
+
         logging.info('Tagging possible connectives...')
         start_time = time.time()
 
+        lemma_index = LemmaIndex(sentences)
         if (self._ptb_strings is not None
             and self._num_sentences == len(sentences)):
             ptb_strings = self._ptb_strings
             self._ptb_strings = None
         else:
-            ptb_strings = self._preprocess_sentences(sentences)
+            # Only sentences containing all the lemmas of some learned
+            # connective can produce candidates, so the rest aren't worth
+            # preprocessing.
+            candidate_indices = set()
+            for connective_lemmas in set(
+                    tuple(connective_lemmas) for _, _, connective_lemmas
+                    in self.tregex_patterns):
+                candidate_indices.update(
+                    lemma_index.get_sentence_indices(connective_lemmas))
+            logging.info('%d of %d sentences contain a known connective',
+                         len(candidate_indices), len(sentences))
+            ptb_strings = self._preprocess_sentences(sentences,
+                                                     candidate_indices)
 
         # Interacting with the TRegex processes is heavily I/O-bound, plus we
         # really want multiple TRegex processes running in parallel, so we farm
         # out patterns to worker threads.
 
-        # Queue up the patterns
-        total_estimated_bytes = 0
-        queue = Queue.Queue()
+        # Pattern jobs all refer to trees by sentence index in this one copy
+        # of the corpus, rather than writing out their own copies.
+        corpus = PreprocessedCorpus(ptb_strings)
+        del ptb_strings
+
+        # Gather up the pattern jobs
+        jobs = []
+        # TODO: Should we filter candidate sentences by whether there are
+        # enough tokens in the sentence to match the rest of the pattern, too?
+        use_native_matcher = (FLAGS.tregex_native_matcher and
+                              FLAGS.tregex_pattern_type == 'dependency')
+        quarantine = PatternQuarantine(FLAGS.tregex_quarantine_path)
+        num_tregex_patterns = 0 # patterns that need the real TRegex
+        num_quarantined = 0
         for (pattern, connective_labels, connective_lemmas
              ) in self.tregex_patterns:
-            possible_sentence_indices = self._filter_sentences_for_pattern(
-                sentences, pattern, connective_lemmas)
-            queue.put_nowait((pattern, connective_labels,
-                              possible_sentence_indices, connective_lemmas))
-            # Estimate total output file size for this pattern: each
-            # sentence has sentence #, + 3 bytes for : and newlines.
-            # As a very rough estimate, matching node names increase the
-            # bytes used by ~1.85x.
-            total_estimated_bytes += sum(
-                1.85 * (int(log10(i + 1)) + 3)
-                for i in range(len(possible_sentence_indices)))
+            possible_sentence_indices = lemma_index.get_sentence_indices(
+                connective_lemmas)
+            if not possible_sentence_indices: # no sentences to scan
+                continue
+            matcher = None
+            if use_native_matcher:
+                try:
+                    matcher = DependencyPatternMatcher(
+                        pattern, ['cause', 'effect'] + list(connective_labels))
+                except UnsupportedPatternError as e:
+                    logging.debug('Falling back to TRegex: %s', e)
+            if matcher is None:
+                if pattern in quarantine:
+                    num_quarantined += 1
+                    if FLAGS.tregex_quarantine_action == 'skip':
+                        continue
+                    stuck_tree_hashes = quarantine.get_stuck_tree_hashes(
+                        pattern)
+                    possible_sentence_indices = [
+                        i for i in possible_sentence_indices
+                        if corpus.get_tree_hash(i) not in stuck_tree_hashes]
+                    if not possible_sentence_indices:
+                        continue
+                num_tregex_patterns += 1
+            jobs.append((pattern, connective_labels, possible_sentence_indices,
+                         connective_lemmas, matcher))
+        if use_native_matcher:
+            logging.info('%d patterns will be run through TRegex',
+                         num_tregex_patterns)
+            if FLAGS.tregex_merge_patterns:
+                jobs = self._merge_jobs(jobs)
+        total_candidates = sum(len(job[2]) for job in jobs)
+        if num_quarantined:
+            logging.info('%d quarantined patterns (action: %s)',
+                         num_quarantined, FLAGS.tregex_quarantine_action)
 
         predicted_outputs = [[] for _ in range(len(sentences))]
-        logging.info("%d patterns in queue", queue.qsize())
-        # Start the threads
-        threads = []
-        for _ in range(FLAGS.tregex_max_threads):
-            new_thread = self.TregexProcessorThread(
-                sentences, ptb_strings, queue, predicted_outputs)
-            threads.append(new_thread)
-            new_thread.start()
-
-        # Set up progress reporter and wait for threads to finish.
-        all_threads_done = [False] # use a list for passing by ref (EVIL HACK)
-        progress_reporter = self._make_progress_reporter(
-            threads, total_estimated_bytes, all_threads_done)
+        logging.info("%d patterns to run", len(jobs))
+        num_threads = min(FLAGS.tregex_max_threads, len(jobs))
+        # Trees for native matching are parsed on demand by the threads.
+        parsed_trees = [None] * len(corpus)
+        workers = []
+        cache = DiskCache(FLAGS.tregex_cache_path,
+                          FLAGS.tregex_cache_max_mb * 2 ** 20)
+        # Timing key -> seconds per candidate sentence, filled in by the threads
+        pattern_timings = {}
+        stats_log = None
         try:
-            progress_reporter.start()
-            queue.join()
+            if FLAGS.tregex_stats_path:
+                stats_log = PatternStatsLog(FLAGS.tregex_stats_path)
+            # TRegex jobs get a queue of their own, so that they can be kept to
+            # the threads that have TRegex workers.
+            tregex_queue = self._make_job_queue(
+                [job for job in jobs if job[4] is None], cache)
+            native_queue = self._make_job_queue(
+                [job for job in jobs if job[4] is not None], cache)
+
+            num_tregex_threads = num_threads
+            if (FLAGS.tregex_persistent_workers and num_threads
+                and num_tregex_patterns and FLAGS.tregex_server_workers > 0):
+                # Every worker loads the whole preprocessed corpus once; each
+                # pattern then just names the sentences it should be run on.
+                # Workers are expensive, so start no more than there are
+                # patterns to give them, and no more than we can afford the
+                # memory for.
+                num_tregex_threads = min(num_threads, num_tregex_patterns,
+                                         FLAGS.tregex_server_workers)
+                workers = [TRegexWorker(corpus.path)
+                           for _ in range(num_tregex_threads)]
+
+            # Start the threads
+            threads = []
+            for i in range(num_threads):
+                if i < num_tregex_threads:
+                    # TRegex jobs are the slow ones, so start on them first.
+                    queues = [tregex_queue, native_queue]
+                else:
+                    queues = [native_queue]
+                new_thread = self.TregexProcessorThread(
+                    sentences, corpus, parsed_trees, queues, predicted_outputs,
+                    cache, pattern_timings, quarantine, stats_log,
+                    workers[i] if i < len(workers) else None)
+                threads.append(new_thread)
+                new_thread.start()
+
+            # Set up progress reporter and wait for threads to finish.
+            all_threads_done = [False] # list for passing by ref (EVIL HACK)
+            progress_reporter = self._make_progress_reporter(
+                threads, total_candidates, all_threads_done)
+            try:
+                progress_reporter.start()
+                tregex_queue.join()
+                native_queue.join()
+            finally:
+                # Make sure progress reporter exits
+                all_threads_done[0] = True
         finally:
-            # Make sure progress reporter exits
-            all_threads_done[0] = True
+            for worker in workers:
+                worker.close()
+            corpus.close()
+            quarantine.save()
+            if stats_log is not None:
+                stats_log.close()
+            if FLAGS.tregex_cache_writes:
+                cache.put_many([(timing_key, repr(seconds)) for timing_key,
+                                seconds in pattern_timings.iteritems()])
+            logging.info('TRegex cache: %s', cache.get_stats_string())
+            cache.close()
 
         elapsed_seconds = time.time() - start_time
         logging.info("Done tagging possible connectives in %0.2f seconds"
@@ -119,17 +340,106 @@ class TRegexConnectiveModel(Model):
         # predicted_outputs has now been modified by the threads.
         return predicted_outputs
 
+    @staticmethod
+    def _merge_jobs(jobs):
+        '''
+        Combines natively matched jobs whose patterns have the same structure,
+        connective labels, and connective lemmas (and hence the same candidate
+        sentences), so that each group is matched in a single search. A merged
+        matcher still reports its matches separately for each original
+        pattern, so the PossibleCausations it produces are the same as the
+        unmerged patterns would have produced.
+        '''
+        merged_jobs = []
+        matchers_by_key = {} # merge key -> (job index, matchers)
+        for job in jobs:
+            pattern, connective_labels, _, connective_lemmas, matcher = job
+            if matcher is None:
+                merged_jobs.append(job)
+                continue
+            merge_key = (matcher.get_signature(), tuple(connective_labels),
+                         tuple(connective_lemmas))
+            try:
+                matchers_by_key[merge_key][1].append(matcher)
+            except KeyError:
+                matchers_by_key[merge_key] = (len(merged_jobs), [matcher])
+                merged_jobs.append(job)
+
+        for job_index, matchers in matchers_by_key.itervalues():
+            if len(matchers) > 1:
+                merged_jobs[job_index] = merged_jobs[job_index][:4] + (
+                    DependencyPatternMatcher.merge(matchers),)
+        logging.info('Merged %d natively matched patterns into %d',
+                     len(jobs) - len(merged_jobs) + len(matchers_by_key),
+                     len(matchers_by_key))
+        return merged_jobs
+
+    @staticmethod
+    def _get_timing_key(pattern, matcher):
+        # Native matching and TRegex run at very different speeds.
+        if matcher is None:
+            return DiskCache.make_key('timing', pattern, 'tregex')
+        return DiskCache.make_key('timing', *(matcher.patterns + ['native']))
+
+    @staticmethod
+    def _make_job_queue(jobs, cache):
+        '''
+        Returns a queue that hands out the pattern jobs most expensive first,
+        so that long jobs don't get started just as all the others finish.
+
+        A job's cost is its number of candidate sentences times the time per
+        sentence its pattern took the last time it was run. For patterns that
+        haven't been timed yet, the time per sentence is estimated from the
+        number of pattern segments, which are what make TRegex slow.
+        '''
+        timing_keys = [TRegexConnectiveModel._get_timing_key(job[0], job[4])
+                       for job in jobs]
+        recorded_timings = {
+            timing_key: float(seconds) for timing_key, seconds
+            in cache.get_many(timing_keys).iteritems()}
+        segment_counts = [job[0].count(' : ') + 1 for job in jobs]
+        seconds_per_segment = [
+            recorded_timings[timing_key] / num_segments
+            for timing_key, num_segments in zip(timing_keys, segment_counts)
+            if timing_key in recorded_timings]
+        try:
+            mean_seconds_per_segment = (sum(seconds_per_segment)
+                                        / len(seconds_per_segment))
+        except ZeroDivisionError: # nothing's been timed yet
+            mean_seconds_per_segment = 1.0
+
+        queue = Queue.PriorityQueue()
+        for job_index, (job, timing_key, num_segments) in enumerate(
+                zip(jobs, timing_keys, segment_counts)):
+            seconds_per_sentence = recorded_timings.get(
+                timing_key, num_segments * mean_seconds_per_segment)
+            cost = len(job[2]) * seconds_per_sentence
+            # The queue hands out the smallest items first, so the cost is
+            # negated. The index keeps the order of equal-cost jobs stable.
+            queue.put_nowait((-cost, job_index, job))
+        return queue
+
     #####################################
     # Sentence preprocessing
     #####################################
 
+    _PLACEHOLDER_TREE = '(ROOT)\n'
+
     @staticmethod
-    def _preprocess_sentences(sentences):
+    def _preprocess_sentences(sentences, sentence_indices=None):
+        '''
+        Returns the preprocessed PTB string for each sentence. If
+        `sentence_indices` is given, only the sentences it contains are
+        preprocessed, and all others get a placeholder tree that no pattern can
+        match.
+        '''
         logging.info("Preprocessing sentences...")
         ptb_strings = []
-        for sentence in sentences:
+        for i, sentence in enumerate(sentences):
             sentence.possible_causations = []
-            if FLAGS.tregex_pattern_type == 'dependency':
+            if sentence_indices is not None and i not in sentence_indices:
+                ptb_strings.append(TRegexConnectiveModel._PLACEHOLDER_TREE)
+            elif FLAGS.tregex_pattern_type == 'dependency':
                 ptb_strings.append(sentence.dep_to_ptb_tree_string() + '\n')
             else:
                 ptb_strings.append(sentence.constituency_tree.pformat() + '\n')
@@ -156,26 +466,15 @@ class TRegexConnectiveModel(Model):
                 path.join(module_dir, 'tsurgeon_dep', script_name) + '.ts'
                 for script_name in tsurgeon_script_names]
 
-            with tempfile.NamedTemporaryFile('w', prefix='trees',
-                                             delete=False) as tree_file:
-                encoded_strings = [s.encode('utf-8') for s in ptb_strings]
-                tree_file.writelines(encoded_strings)
-                tree_file.flush()
-                with tempfile.NamedTemporaryFile(
-                    'w+b', prefix='tsurgeon', delete=False) as surgeried_file:
-                    tsurgeon_command = (
-                        ([path.join(FLAGS.tregex_dir, 'tsurgeon.sh'), '-s',
-                          '-treeFile', tree_file.name]
-                         + tsurgeon_script_names))
-                    devnull = ( # To debug errors, change to stderr
-                        TRegexConnectiveModel.TregexProcessorThread.dev_null)
-                    retval = subprocess.call(
-                        tsurgeon_command, stdout=surgeried_file, stderr=devnull)
-                    if retval != 0:
-                        raise RuntimeError("TSurgeon command failed: %s"
-                                           % tsurgeon_command)
-                    surgeried_file.seek(0)
-                    ptb_strings = surgeried_file.readlines()
+            if sentence_indices is None:
+                to_preprocess = range(len(sentences))
+            else:
+                to_preprocess = sorted(sentence_indices)
+            surgeried_strings = TRegexConnectiveModel._run_tsurgeon_with_cache(
+                [ptb_strings[i].encode('utf-8') for i in to_preprocess],
+                tsurgeon_script_names)
+            for i, surgeried_string in zip(to_preprocess, surgeried_strings):
+                ptb_strings[i] = surgeried_string
         else:
             # Temporary measure until we get TSurgeon scripts updated for
             # constituency parses: don't do any real preprocessing.
@@ -187,17 +486,77 @@ class TRegexConnectiveModel(Model):
         return ptb_strings
 
     @staticmethod
-    def _filter_sentences_for_pattern(sentences, pattern, connective_lemmas):
-        possible_sentence_indices = []
-        for i, sentence in enumerate(sentences):
-            token_lemmas = [token.lemma for token in sentence.tokens]
-            # TODO: Should we filter here by whether there are enough tokens in
-            # the sentence to match the rest of the pattern, too?
-            if all([connective_lemma in token_lemmas
-                    for connective_lemma in connective_lemmas]):
-                possible_sentence_indices.append(i)
+    def _run_tsurgeon_with_cache(ptb_strings, script_paths):
+        '''
+        Returns the results of running the TSurgeon scripts at `script_paths`
+        on each of the (encoded) trees in `ptb_strings`. Results are cached per
+        tree, keyed by the tree and the scripts' contents, so TSurgeon only
+        runs on trees it hasn't already normalized with the current scripts.
+        '''
+        script_contents = []
+        for script_path in script_paths:
+            with open(script_path) as script_file:
+                script_contents.append(script_file.read())
+        scripts_key = DiskCache.make_key('tsurgeon', *script_contents)
+        cache_keys = [DiskCache.make_key(scripts_key, ptb_string)
+                      for ptb_string in ptb_strings]
+
+        cache = DiskCache(FLAGS.tregex_cache_path,
+                          FLAGS.tregex_cache_max_mb * 2 ** 20)
+        locked_keys = []
+        try:
+            surgeried_strings = cache.get_many(cache_keys)
+            if FLAGS.tregex_cache_writes:
+                # Wait for any other run that's normalizing the same trees.
+                locked_keys = [cache_key for cache_key in cache_keys
+                               if cache_key not in surgeried_strings]
+                cache.lock_entries(locked_keys)
+                surgeried_strings.update(cache.get_many(locked_keys))
+            uncached = [(cache_key, ptb_string) for cache_key, ptb_string
+                        in zip(cache_keys, ptb_strings)
+                        if cache_key not in surgeried_strings]
+            logging.info('%d of %d trees already normalized',
+                         len(ptb_strings) - len(uncached), len(ptb_strings))
+            if uncached:
+                new_strings = zip(
+                    [cache_key for cache_key, _ in uncached],
+                    TRegexConnectiveModel._run_tsurgeon(
+                        [ptb_string for _, ptb_string in uncached],
+                        script_paths))
+                if FLAGS.tregex_cache_writes:
+                    cache.put_many(new_strings)
+                surgeried_strings.update(new_strings)
+        finally:
+            cache.unlock_entries(locked_keys)
+            cache.close()
+
+        return [surgeried_strings[cache_key] for cache_key in cache_keys]
 
-        return possible_sentence_indices
+    @staticmethod
+    def _run_tsurgeon(ptb_strings, script_paths):
+        with tempfile.NamedTemporaryFile('w', prefix='trees') as tree_file:
+            tree_file.writelines(ptb_strings)
+            tree_file.flush()
+            with tempfile.TemporaryFile('w+b',
+                                        prefix='tsurgeon') as surgeried_file:
+                tsurgeon_command = (
+                    ([path.join(FLAGS.tregex_dir, 'tsurgeon.sh'), '-s',
+                      '-treeFile', tree_file.name]
+                     + script_paths))
+                devnull = ( # To debug errors, change to stderr
+                    TRegexConnectiveModel.TregexProcessorThread.dev_null)
+                retval = subprocess.call(
+                    tsurgeon_command, stdout=surgeried_file, stderr=devnull)
+                if retval != 0:
+                    raise RuntimeError("TSurgeon command failed: %s"
+                                       % tsurgeon_command)
+                surgeried_file.seek(0)
+                surgeried_strings = surgeried_file.readlines()
+
+        if len(surgeried_strings) != len(ptb_strings):
+            raise RuntimeError("TSurgeon returned %d trees for %d inputs"
+                               % (len(surgeried_strings), len(ptb_strings)))
+        return surgeried_strings
 
     #####################################
     # Pattern generation
@@ -281,8 +640,7 @@ class TRegexConnectiveModel(Model):
     def _get_cons_node_pattern(sentence, node_index, node_names,
                                connective_nodes, steiner_nodes, cause_node,
                                effect_node):
-        tree = sentence.constituency_tree # for brevity
-        node = subtree_at_index(tree, node_index)
+        node = sentence.get_constituency_tables().subtrees[node_index]
 
         try:
             connective_index = connective_nodes.index(node)
@@ -478,30 +836,26 @@ class TRegexConnectiveModel(Model):
     @staticmethod
     def _get_constituency_pattern(sentence, connective_tokens, cause_tokens,
                                   effect_tokens):
-        # TODO: optimize shortest-path calculations on graph to be done only
-        # once? (currently happen repeatedly in steiner_tree)
-        constituency_tree = sentence.constituency_tree # for brevity
+        tables = sentence.get_constituency_tables()
         cause_node = sentence.get_constituency_node_for_tokens(cause_tokens)
         effect_node = sentence.get_constituency_node_for_tokens(effect_tokens)
-        connective_treepositions = [
-            # Index includes ROOT token, so subtract 1.
-            constituency_tree.leaf_treeposition(t.index - 1)
-            for t in connective_tokens]
-        # Leaf treepositions get us to the words themselves. We want the nodes
-        # just above the words, so we lop off the ends of the positions.
-        connective_nodes = [constituency_tree[position[:-1]]
-                            for position in connective_treepositions]
-        # Use IDs of terminal nodes so we can do quick checks for identity,
-        # rather than expensive recursive equality checks.
-        terminal_ids = [id(terminal) for terminal
-                        in [cause_node, effect_node] + connective_nodes]
-        terminal_indices = [
-            i for (i, subtree) in enumerate(constituency_tree.subtrees())
-            if id(subtree) in terminal_ids]
+        # We want the nodes just above the connective words. (Token index
+        # includes ROOT token, so subtract 1.)
+        connective_nodes = [tables.preterminals[t.index - 1]
+                            for t in connective_tokens]
+        terminal_ids = set(id(terminal) for terminal
+                           in [cause_node, effect_node] + connective_nodes)
+        terminal_indices = sorted(
+            tables.subtree_indices[terminal_id] for terminal_id in terminal_ids
+            if terminal_id in tables.subtree_indices)
+        # The shortest paths are shared by all instances in the sentence, the
+        # same way the dependency graph's are.
+        path_costs, path_predecessors = sentence.get_constituency_paths()
         steiner_nodes, steiner_graph = steiner_tree(
-            sentence.constituency_graph, terminal_indices, directed=False)
+            sentence.constituency_graph, terminal_indices, path_costs,
+            path_predecessors, directed=False)
 
-        path_seed_index = index_of_subtree(connective_nodes[0])
+        path_seed_index = tables.subtree_indices[id(connective_nodes[0])]
         return TRegexConnectiveModel._generate_pattern_from_steiners(
             sentence, steiner_graph, steiner_nodes, connective_nodes,
             cause_node, effect_node, path_seed_index)
@@ -525,162 +879,484 @@ class TRegexConnectiveModel(Model):
         logging.info('Extracting patterns...')
         if FLAGS.print_patterns:
             print 'Patterns:'
-        for sentence, ptb_string in zip(sentences, preprocessed_ptb_strings):
-            if FLAGS.tregex_pattern_type == 'dependency':
-                sentence = sentence.substitute_dep_ptb_graph(ptb_string)
-            for instance in sentence.causation_instances:
-                if instance.cause != None and instance.effect is not None:
-                    pattern, node_names = self._get_pattern(
-                        sentence, instance.connective, instance.cause,
-                        instance.effect)
-
-                    if pattern is None:
-                        continue
-
-                    if pattern not in patterns_seen:
-                        if FLAGS.print_patterns:
-                            print ' ', pattern.encode('utf-8')
-                            print '  Sentence:', (sentence.original_text.encode(
-                                                    'utf-8'))
-                            print
-                        patterns_seen.add(pattern)
-                        connective_lemmas = [t.lemma for t
-                                             in instance.connective]
-                        self.tregex_patterns.append((pattern, node_names,
-                                                     connective_lemmas))
+        patterns_by_sentence = self._get_patterns_by_sentence(
+            sentences, preprocessed_ptb_strings)
+        for sentence, sentence_patterns in itertools.izip(
+                sentences, patterns_by_sentence):
+            for pattern, node_names, connective_lemmas in sentence_patterns:
+                if pattern not in patterns_seen:
+                    if FLAGS.print_patterns:
+                        print ' ', pattern.encode('utf-8')
+                        print '  Sentence:', (sentence.original_text.encode(
+                                                'utf-8'))
+                        print
+                    patterns_seen.add(pattern)
+                    self.tregex_patterns.append((pattern, node_names,
+                                                 connective_lemmas))
         sys.stdout.flush()
         logging.info('Done extracting patterns.')
 
         return preprocessed_ptb_strings
 
+    # Bump this whenever pattern generation changes, so that memoized patterns
+    # from older code don't get reused.
+    _PATTERN_MEMO_VERSION = '1'
+
+    @staticmethod
+    def _get_pattern_memo_key(sentence, ptb_string):
+        '''
+        Returns the cache key for the patterns of `sentence`. A sentence's
+        patterns depend only on its parse, its tokens, and its pairwise
+        causation instances (plus the pattern flags), so they're the same in
+        every cross-validation fold and every run.
+        '''
+        instance_parts = []
+        for instance in sentence.causation_instances:
+            if instance.cause is not None and instance.effect is not None:
+                instance_parts.append('|'.join(
+                    ','.join(str(token.index) for token in tokens)
+                    for tokens in [instance.connective, instance.cause,
+                                   instance.effect]))
+        token_fingerprint = u' '.join(u'%s/%s' % (token.lemma, token.pos)
+                                      for token in sentence.tokens)
+        return DiskCache.make_key(
+            'patterns', TRegexConnectiveModel._PATTERN_MEMO_VERSION,
+            FLAGS.tregex_pattern_type, str(FLAGS.tregex_max_steiners),
+            ptb_string, token_fingerprint, *instance_parts)
+
+    @staticmethod
+    def _get_patterns_by_sentence(sentences, ptb_strings):
+        '''
+        Returns the list of patterns (see `_get_sentence_patterns`) for each
+        sentence, looking them up in the memo stored in the TRegex cache when
+        possible, and generating (and memoizing) them when not.
+        '''
+        global _extraction_inputs
+        cache = DiskCache(FLAGS.tregex_cache_path,
+                          FLAGS.tregex_cache_max_mb * 2 ** 20)
+        pool = None
+        try:
+            memo_keys = [
+                TRegexConnectiveModel._get_pattern_memo_key(sentence,
+                                                            ptb_string)
+                for sentence, ptb_string in zip(sentences, ptb_strings)]
+            memoized = cache.get_many(memo_keys)
+            patterns_by_sentence = [
+                cPickle.loads(memoized[key]) if key in memoized else None
+                for key in memo_keys]
+            missing_indices = [i for i, key in enumerate(memo_keys)
+                               if key not in memoized]
+            logging.info('Found memoized patterns for %d of %d sentences',
+                         len(sentences) - len(missing_indices),
+                         len(sentences))
+
+            if FLAGS.tregex_extraction_processes > 1 and missing_indices:
+                # Worker processes get the inputs by inheriting them when
+                # they're forked, rather than having every sentence pickled
+                # over to them.
+                _extraction_inputs = (sentences, ptb_strings)
+                pool = multiprocessing.Pool(FLAGS.tregex_extraction_processes)
+                chunk_size = max(1, len(missing_indices)
+                                    / (4 * FLAGS.tregex_extraction_processes))
+                new_patterns = pool.imap(_get_sentence_patterns_for_pool,
+                                         missing_indices, chunk_size)
+            else:
+                new_patterns = (
+                    TRegexConnectiveModel._get_sentence_patterns(
+                        sentences[i], ptb_strings[i])
+                    for i in missing_indices)
+
+            memo_items = []
+            for i, sentence_patterns in itertools.izip(missing_indices,
+                                                       new_patterns):
+                patterns_by_sentence[i] = sentence_patterns
+                memo_items.append((memo_keys[i], cPickle.dumps(
+                    sentence_patterns, cPickle.HIGHEST_PROTOCOL)))
+            if FLAGS.tregex_cache_writes:
+                cache.put_many(memo_items)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+                _extraction_inputs = None
+            cache.close()
+
+        return patterns_by_sentence
+
+    @staticmethod
+    def _get_sentence_patterns(sentence, ptb_string):
+        '''
+        Returns a (pattern, node_names, connective_lemmas) tuple for each
+        pairwise causation instance in `sentence` that yields a pattern.
+        '''
+        if FLAGS.tregex_pattern_type == 'dependency':
+            sentence = sentence.substitute_dep_ptb_graph(ptb_string)
+        sentence_patterns = []
+        for instance in sentence.causation_instances:
+            if instance.cause != None and instance.effect is not None:
+                pattern, node_names = TRegexConnectiveModel._get_pattern(
+                    sentence, instance.connective, instance.cause,
+                    instance.effect)
+                if pattern is not None:
+                    connective_lemmas = [t.lemma for t in instance.connective]
+                    sentence_patterns.append((pattern, node_names,
+                                              connective_lemmas))
+        return sentence_patterns
+
     #####################################
     # Running TRegex
     #####################################
 
     class TregexProcessorThread(threading.Thread):
-        def __init__(self, sentences, ptb_strings, queue, predicted_outputs,
-                     *args, **kwargs):
+        def __init__(self, sentences, corpus, parsed_trees, queues,
+                     predicted_outputs, cache, pattern_timings, quarantine,
+                     stats_log=None, worker=None, *args, **kwargs):
             super(TRegexConnectiveModel.TregexProcessorThread, self).__init__(
                 *args, **kwargs)
             self.sentences = sentences
-            self.ptb_strings = ptb_strings
-            self.queue = queue
+            self.corpus = corpus # PreprocessedCorpus shared by all threads
+            # Shared list of PTBTrees, filled in lazily for native matching.
+            self.parsed_trees = parsed_trees
+            self.queues = queues # job queues to work through, in order
             self.predicted_outputs = predicted_outputs
-            self.output_file = None
-            self.total_bytes_output = 0
-            # We associate a lock with the output file to prevent concurrency
-            # errors where progress reporting calls tell() at the same time as
-            # the main thread closes the file.
-            self.file_lock = Lock()
+            self.cache = cache # DiskCache shared by all threads
+            self.pattern_timings = pattern_timings
+            self.quarantine = quarantine # PatternQuarantine shared by threads
+            self.stats_log = stats_log # PatternStatsLog, if we're logging
+            self.worker = worker # TRegexWorker, if we're using one
+            # Number of candidate sentences processed so far. (Updates are
+            # atomic, so the progress reporter can read this without a lock.)
+            self.sentences_processed = 0
 
         dev_null = open('/dev/null', 'w')
 
         def run(self):
-            try:
-                while(True):
-                    (pattern, connective_labels, possible_sentence_indices,
-                     connective_lemmas) = self.queue.get_nowait()
-                    if not possible_sentence_indices: # no sentences to scan
-                        self.queue.task_done()
-                        continue
-
-                    possible_trees = [self.ptb_strings[i]
-                                      for i in possible_sentence_indices]
-                    possible_sentences = [(i, self.sentences[i])
-                                          for i in possible_sentence_indices]
-
-                    with tempfile.NamedTemporaryFile(
-                        'w', prefix='trees') as tree_file:
-                        # logging.debug("Trees written to %s (pattern: %s)"
-                        #              % (tree_file.name, pattern))
-                        tree_file.writelines(possible_trees)
-                        # Make sure the file is synced for threads to access
-                        tree_file.flush()
-                        self._process_pattern(
-                            pattern, connective_labels, connective_lemmas,
-                            possible_sentences, tree_file.name)
-                    self.queue.task_done()
-            except Queue.Empty: # no more items in queue
-                return
+            for queue in self.queues:
+                try:
+                    while(True):
+                        _, _, job = queue.get_nowait()
+                        self._run_job(*job)
+                        queue.task_done()
+                except Queue.Empty: # no more items in this queue
+                    pass
+
+        def _run_job(self, pattern, connective_labels,
+                     possible_sentence_indices, connective_lemmas, matcher):
+            start_time = time.time()
+            possible_sentences = [(i, self.sentences[i])
+                                  for i in possible_sentence_indices]
+            job_stats = self._process_pattern(
+                pattern, connective_labels, connective_lemmas,
+                possible_sentences, matcher)
+            elapsed_seconds = time.time() - start_time
+            # Record timing for scheduling future runs. Only sentences that
+            # actually had to be matched count; cache hits are nearly free, and
+            # would make the pattern look cheaper than it is.
+            num_matched = (len(possible_sentences)
+                           - job_stats['cached_sentences'])
+            if num_matched:
+                timing_key = TRegexConnectiveModel._get_timing_key(pattern,
+                                                                   matcher)
+                self.pattern_timings[timing_key] = (
+                    elapsed_seconds / num_matched)
+
+            if self.stats_log is not None:
+                job_stats.update({
+                    'pattern': pattern,
+                    'matcher': 'tregex' if matcher is None else 'native',
+                    'merged_patterns': (1 if matcher is None
+                                        else len(matcher.patterns)),
+                    'candidates': len(possible_sentences),
+                    'cache_hit': (job_stats['cached_sentences']
+                                  == len(possible_sentences)),
+                    'start_time': start_time,
+                    'seconds': elapsed_seconds,
+                    'thread': self.name})
+                self.stats_log.write(job_stats)
 
         _FIXED_TREGEX_ARGS = '-o -l -N -h cause -h effect'.split()
-        def _run_tregex(self, pattern, connective_labels, tree_file_path):
-            logging.debug("Processing %s to %s"
-                          % (pattern, self.output_file.name))
-            if FLAGS.tregex_pattern_type == 'dependency':
-                output_type_arg = '-u'
+        def _run_tregex(self, pattern, connective_labels, tree_indices):
+            '''
+            Runs TRegex on the trees at `tree_indices`, and yields its output
+            lines for each tree. Output is parsed as it is produced, so each
+            tree's lines are available as soon as TRegex has finished with that
+            tree. The generator must be exhausted to let the TRegex process
+            finish.
+
+            If TRegex spends more than FLAGS.tregex_timeout seconds on any one
+            tree, it is killed, and TRegexTimeoutError is raised once the
+            output for the trees it did finish has been yielded.
+            '''
+            logging.debug("Running TRegex on %d trees: %s"
+                          % (len(tree_indices), pattern))
+            if self.worker is not None:
+                process = self.worker.process
+                output_lines = self.worker.run_pattern(
+                    pattern, ['cause', 'effect'] + list(connective_labels),
+                    tree_indices)
             else:
-                output_type_arg = '-x'
+                process, output_lines = self._start_tregex_process(
+                    pattern, connective_labels, tree_indices)
 
+            watchdog = None
+            if FLAGS.tregex_timeout:
+                watchdog = Watchdog(FLAGS.tregex_timeout,
+                                    lambda: kill_process_group(process))
+            try:
+                for tree_lines in self._split_tregex_output(output_lines):
+                    # Don't count time spent processing the output.
+                    if watchdog is not None:
+                        watchdog.stop_clock()
+                    yield tree_lines
+                    if watchdog is not None:
+                        watchdog.restart_clock()
+            except RuntimeError:
+                # Killing TRegex makes it look like it failed or exited.
+                if watchdog is None or not watchdog.fired:
+                    raise
+            finally:
+                if watchdog is not None:
+                    watchdog.stop()
+            if watchdog is not None and watchdog.fired:
+                raise TRegexTimeoutError(
+                    "TRegex timed out after %d seconds (pattern: %s)"
+                    % (FLAGS.tregex_timeout, pattern))
+
+        def _start_tregex_process(self, pattern, connective_labels,
+                                  tree_indices):
+            '''
+            Starts a TRegex process on the trees at `tree_indices`. Returns the
+            process and an iterator over its output lines.
+            '''
             connective_printing_args = []
             for connective_label in connective_labels:
                 connective_printing_args.extend(['-h', connective_label])
 
+            # -filter makes TRegex read trees from stdin.
             tregex_command = (
-                [path.join(FLAGS.tregex_dir, 'tregex.sh'), output_type_arg]
+                [path.join(FLAGS.tregex_dir, 'tregex.sh'),
+                 TRegexWorker.get_output_type_arg()]
                 + self._FIXED_TREGEX_ARGS + connective_printing_args
-                + [pattern, tree_file_path])
+                + ['-filter', pattern])
             devnull = TRegexConnectiveModel.TregexProcessorThread.dev_null
-            retcode = subprocess.call(tregex_command, stdout=self.output_file,
-                                      stderr=devnull) # Edit to debug problems
-            if retcode != 0:
-                raise RuntimeError("TRegex command failed: %s" % tregex_command)
-
-        _TREGEX_CACHE_DIR = home = path.expanduser("~/tregex_cache")
-        def _create_output_file_if_not_exists(self, pattern, connective_labels,
-                                              tree_file_path):
-            pattern_dir_name = pattern.replace('/', '\\')
-            if len(pattern_dir_name) > FLAGS.tregex_max_cache_filename_len:
-                # The combination of the start of the pattern plus the hash
-                # should be very hard indeed to accidentally match.
-                pattern_hash = hash(pattern_dir_name)
-                # Leave room for up to 20 characters of numerical hash (the max
-                # we could get on a 64-bit system).
-                pattern_dir_name = pattern_dir_name[:FLAGS.tregex_max_cache_filename_len - 20]
-                pattern_dir_name += str(pattern_hash)
-
-            file_hash = hash_file(tree_file_path)
-            cache_dir_name = path.join(self._TREGEX_CACHE_DIR, pattern_dir_name)
-            cache_file_name = path.join(cache_dir_name, file_hash)
-            try:
-                self.output_file = open(cache_file_name, 'rb')
-            except IOError: # No such file
+            # The process gets a group of its own so that it can be killed
+            # along with its JVM (see kill_process_group).
+            process = subprocess.Popen(
+                tregex_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull, # Edit to debug problems
+                preexec_fn=os.setsid)
+
+            # Write the trees from a separate thread, so that TRegex can't get
+            # stuck writing to a full output pipe while we're still writing
+            # its input.
+            trees = [self.corpus.get_tree(i) for i in tree_indices]
+            writer = threading.Thread(target=self._write_trees,
+                                      args=(process.stdin, trees))
+            writer.daemon = True
+            writer.start()
+
+            def iter_output_lines():
+                for line in iter(process.stdout.readline, ''):
+                    yield line
+                writer.join()
+                retcode = process.wait()
+                if retcode != 0:
+                    raise RuntimeError("TRegex command failed: %s"
+                                       % tregex_command)
+            return process, iter_output_lines()
+
+        def _iter_tregex_outputs(self, pattern, connective_labels,
+                                 tree_indices):
+            '''
+            Yields TRegex's output lines for each tree in `tree_indices`, or
+            None for each tree that TRegex timed out on or was skipped because
+            of a timeout. After a timeout, the pattern is quarantined, and
+            depending on FLAGS.tregex_quarantine_action, TRegex is either
+            restarted on the trees after the one it got stuck on, or the rest
+            of the trees are skipped.
+            '''
+            remaining_indices = list(tree_indices)
+            while remaining_indices:
+                num_done = 0
                 try:
-                    os.makedirs(cache_dir_name)
-                except OSError:
-                    if not path.isdir(cache_dir_name):
-                        raise
+                    for tree_lines in self._run_tregex(
+                            pattern, connective_labels, remaining_indices):
+                        num_done += 1
+                        yield tree_lines
+                    return
+                except TRegexTimeoutError as e:
+                    if self.worker is not None:
+                        self.worker.restart()
+                    if num_done == len(remaining_indices): # finished anyway
+                        return
+                    # TRegex flushes its output after every tree, so the first
+                    # tree we have no output for is the one it got stuck on.
+                    stuck_index = remaining_indices[num_done]
+                    logging.warn('%s; quarantining pattern (sentence: %s)',
+                                 e, self.sentences[stuck_index].original_text)
+                    self.quarantine.record_timeout(
+                        pattern, self.corpus.get_tree_hash(stuck_index),
+                        FLAGS.tregex_timeout)
+
+                    if FLAGS.tregex_quarantine_action == 'skip':
+                        for _ in remaining_indices[num_done:]:
+                            yield None
+                        return
+                    yield None # for the stuck tree
+                    remaining_indices = remaining_indices[num_done + 1:]
+
+        @staticmethod
+        def _write_trees(stream, trees):
+            try:
+                stream.writelines(trees)
+                stream.close()
+            except IOError: # TRegex died; the reader will report the failure.
+                pass
+
+        @staticmethod
+        def _split_tregex_output(output_lines):
+            '''
+            Groups the lines of TRegex output into a list of lines for each
+            tree, yielding each list as soon as it is complete.
+            '''
+            tree_lines = None
+            for line in output_lines:
+                line = line.strip()
+                if tree_lines is None: # tree num line
+                    tree_lines = []
+                elif line:
+                    tree_lines.append(line)
+                else:
+                    yield tree_lines
+                    tree_lines = None
 
-                self.output_file = open(cache_file_name, 'w+b')
-                self._run_tregex(pattern, connective_labels, tree_file_path)
-                self.output_file.seek(0)
+        def _iter_tregex_lines(self, pattern, connective_labels,
+                               possible_sentence_indices, job_stats):
+            '''
+            Yields the TRegex output lines for each candidate sentence in turn,
+            running TRegex only on the sentences whose results aren't cached.
+            Counts the sentences that were cached in `job_stats`.
+            '''
+            # The key covers everything that determines TRegex's output for a
+            # tree, including the tree itself.
+            pattern_key = DiskCache.make_key(
+                pattern, TRegexWorker.get_output_type_arg(),
+                ' '.join(connective_labels))
+            cache_keys = [
+                DiskCache.make_key(pattern_key, self.corpus.get_tree_hash(i))
+                for i in possible_sentence_indices]
+            cached_outputs = self.cache.get_many(cache_keys)
+            uncached_keys = [cache_key for cache_key in cache_keys
+                             if cache_key not in cached_outputs]
+            if FLAGS.tregex_cache_writes and uncached_keys:
+                # Wait for any other run that's computing the same entries,
+                # then pick up whatever it finished.
+                self.cache.lock_entries(uncached_keys)
+                cached_outputs.update(self.cache.get_many(uncached_keys))
+            else:
+                uncached_keys = []
+
+            try:
+                uncached_indices = [
+                    sentence_index for sentence_index, cache_key
+                    in zip(possible_sentence_indices, cache_keys)
+                    if cache_key not in cached_outputs]
+                if uncached_indices:
+                    new_outputs = self._iter_tregex_outputs(
+                        pattern, connective_labels, uncached_indices)
+                else:
+                    new_outputs = iter([])
+
+                outputs_to_cache = []
+                for cache_key in cache_keys:
+                    if cache_key in cached_outputs:
+                        job_stats['cached_sentences'] += 1
+                        cached_output = cached_outputs[cache_key]
+                        yield (cached_output.split('\n') if cached_output
+                               else [])
+                    else:
+                        try:
+                            lines = next(new_outputs)
+                        except StopIteration:
+                            raise RuntimeError(
+                                "TRegex output ended early (pattern: %s)"
+                                % pattern)
+                        if lines is None: # timed out
+                            job_stats['timed_out_sentences'] += 1
+                            yield []
+                        else:
+                            outputs_to_cache.append(
+                                (cache_key, '\n'.join(lines)))
+                            yield lines
+                for _ in new_outputs: # Let TRegex finish up cleanly
+                    pass
+
+                if FLAGS.tregex_cache_writes and outputs_to_cache:
+                    self.cache.put_many(outputs_to_cache)
+            finally:
+                self.cache.unlock_entries(uncached_keys)
+
+        def _get_parsed_tree(self, sentence_index):
+            tree = self.parsed_trees[sentence_index]
+            if tree is None:
+                # If two threads race to parse the same tree, they'll just
+                # produce identical results, so we don't bother locking.
+                tree = PTBTree(self.corpus.get_tree(sentence_index))
+                self.parsed_trees[sentence_index] = tree
+            return tree
 
         def _process_pattern(self, pattern, connective_labels,
-                             connective_lemmas, possible_sentences,
-                             tree_file_path):
-            self._create_output_file_if_not_exists(pattern, connective_labels,
-                                                   tree_file_path)
-            with self.output_file:
-                for sentence_index, sentence in possible_sentences:
-                    possible_causations = self._process_tregex_for_sentence(
-                        pattern, connective_labels, connective_lemmas, sentence)
-                    # NOTE: This is the ONLY PLACE where we modify shared data.
-                    # It is thread-safe because self.predicted_outputs itself is
-                    # never modified; its individual elements -- themselves
-                    # lists -- are never replaced; and list.extend() is atomic.
-                    self.predicted_outputs[sentence_index].extend(
-                        possible_causations)
-
-                # Tell the progress reporter how far we've gotten, so that it
-                # will know progress for patterns that have already finished.
-                self.total_bytes_output += self.output_file.tell()
-
-                # Lock the file lock as we close the file
-                self.file_lock.acquire()
-            # Now release the lock once the file is closed
-            self.file_lock.release()
-
-            self.output_file = None
+                             connective_lemmas, possible_sentences, matcher):
+            '''
+            Runs the pattern on the candidate sentences and records the
+            resulting PossibleCausations. (For a merged native matcher, each of
+            its original patterns gets credit for its own matches.) Returns a
+            dictionary of statistics about the run.
+            '''
+            job_stats = {'cached_sentences': 0, 'timed_out_sentences': 0,
+                         'bytes_output': 0, 'matches': 0,
+                         'possible_causations': 0}
+            if matcher is not None:
+                # Native matching is cheaper than a cache lookup, so its results
+                # aren't cached.
+                patterns = matcher.patterns
+                lines_by_sentence = (
+                    matcher.match_all(self._get_parsed_tree(i))
+                    for i, _ in possible_sentences)
+            else:
+                patterns = [pattern]
+                lines_by_sentence = (
+                    [lines] for lines in self._iter_tregex_lines(
+                        pattern, connective_labels,
+                        [i for i, _ in possible_sentences], job_stats))
+            # Loop over the output rather than the sentences, so that the
+            # output generator runs to completion. That's what lets
+            # _iter_tregex_lines finish reading TRegex's output and store it
+            # in the cache.
+            for output_index, lines_by_pattern in enumerate(lines_by_sentence):
+                sentence_index, sentence = possible_sentences[output_index]
+                possible_causations = []
+                for original_pattern, lines in zip(patterns, lines_by_pattern):
+                    possible_causations.extend(
+                        self._process_tregex_for_sentence(
+                            original_pattern, connective_labels,
+                            connective_lemmas, sentence, lines))
+                    job_stats['bytes_output'] += sum(len(line) + 1
+                                                     for line in lines)
+                    # Each match prints cause, effect, and connective nodes.
+                    job_stats['matches'] += (
+                        len(lines) / (2 + len(connective_labels)))
+                job_stats['possible_causations'] += len(possible_causations)
+                # NOTE: This is the ONLY PLACE where we modify shared data.
+                # It is thread-safe because self.predicted_outputs itself is
+                # never modified; its individual elements -- themselves
+                # lists -- are never replaced; and list.extend() is atomic.
+                self.predicted_outputs[sentence_index].extend(
+                    possible_causations)
+
+            # Tell the progress reporter how far we've gotten.
+            self.sentences_processed += len(possible_sentences)
+            return job_stats
 
         @staticmethod
         def _get_constituency_token_from_tregex_line(line, sentence,
@@ -699,17 +1375,7 @@ class TRegexConnectiveModel(Model):
             return sentence.tokens[token_index]
 
         def _process_tregex_for_sentence(self, pattern, connective_labels,
-                                         connective_lemmas, sentence):
-            # Read TRegex output for the sentence.
-            # For each sentence, we leave the file positioned at the next
-            # tree number line.
-            self.output_file.readline() # skip tree num line
-            next_line = self.output_file.readline().strip()
-            lines = []
-            while next_line:
-                lines.append(next_line)
-                next_line = self.output_file.readline().strip()
-
+                                         connective_lemmas, sentence, lines):
             true_connectives = {
                 tuple(instance.connective): instance
                 for instance in sentence.causation_instances
@@ -721,6 +1387,9 @@ class TRegexConnectiveModel(Model):
             # The first two printed will be cause/effect; the remainder are
             # connectives.
             batch_size = 2 + len(connective_labels)
+            if FLAGS.tregex_pattern_type != 'dependency':
+                all_treepositions = (sentence.get_constituency_tables()
+                                     .treepositions)
             possible_causations = []
             for match_lines in igroup(lines, batch_size):
                 # TODO: If the argument heads overlap, we can't match the
@@ -744,8 +1413,6 @@ class TRegexConnectiveModel(Model):
                                                                     sentence)
                         for line in connective_lines]
                 else: # constituency
-                    all_treepositions = (sentence.constituency_tree
-                                         .treepositions())
                     cause, effect = [
                         self._get_constituency_token_from_tregex_line(
                             line, sentence, all_treepositions)
@@ -776,32 +1443,20 @@ class TRegexConnectiveModel(Model):
             return possible_causations
 
         def get_progress(self):
-            try:
-                with self.file_lock:
-                    progress = self.total_bytes_output + self.output_file.tell()
-                return progress
-            except (AttributeError, IOError, ValueError):
-                # AttributeError indicates that self.output_file was None.
-                # IOError/ValueError indicate that we managed to ask for file
-                # size just after the file was closed. Either way, that means
-                # that now the total number of bytes has been recorded.
-                return self.total_bytes_output
+            return self.sentences_processed
 
     @staticmethod
-    def _make_progress_reporter(threads, total_estimated_bytes,
-                                all_threads_done):
+    def _make_progress_reporter(threads, total_candidates, all_threads_done):
         def report_progress_loop():
             while(True):
                 time.sleep(4)
                 if all_threads_done[0]:
                     return
-                bytes_output = sum([t.get_progress() for t in threads])
+                sentences_processed = sum([t.get_progress() for t in threads])
                 # Never allow > 99% completion as long as we're still running.
-                # (This can happen if our estimated max sizes turn out to be
-                # off.)
                 try:
                     progress = min(
-                        bytes_output / float(total_estimated_bytes), 0.99)
+                        sentences_processed / float(total_candidates), 0.99)
                 except ZeroDivisionError:
                     progress = 0
                 if not all_threads_done[0]: # Make sure we're still going
@@ -815,6 +1470,303 @@ class TRegexConnectiveModel(Model):
         return progress_reporter
 
 
+# (sentences, preprocessed PTB strings) being used for pattern extraction, for
+# worker processes to inherit.
+_extraction_inputs = None
+
+def _get_sentence_patterns_for_pool(sentence_index):
+    sentences, ptb_strings = _extraction_inputs
+    return TRegexConnectiveModel._get_sentence_patterns(
+        sentences[sentence_index], ptb_strings[sentence_index])
+
+
+class TRegexTimeoutError(RuntimeError):
+    pass
+
+
+def kill_process_group(process):
+    '''
+    Kills `process`, which must have been started as the leader of a new
+    process group, along with everything else in its group. tregex.sh and
+    tregex_server.sh run Java as a child of bash, so killing only the script's
+    process would leave the JVM running (and holding its output pipe open).
+    '''
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError: # The whole group already exited
+        pass
+
+
+class Watchdog(object):
+    '''
+    Calls `on_timeout` from a background thread if the clock runs for more
+    than `timeout` seconds without being restarted. The clock starts running
+    immediately.
+    '''
+
+    def __init__(self, timeout, on_timeout):
+        self.timeout = timeout
+        self.fired = False
+        self._on_timeout = on_timeout
+        self._deadline = time.time() + timeout
+        self._stopped = False
+        # Guards the deadline, and wakes the watch thread when it changes.
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return
+                if self._deadline is None: # clock is stopped
+                    self._condition.wait()
+                    continue
+                wait_time = self._deadline - time.time()
+                if wait_time <= 0:
+                    break
+                self._condition.wait(wait_time)
+            self.fired = True
+        self._on_timeout()
+
+    def stop_clock(self):
+        with self._condition:
+            self._deadline = None
+
+    def restart_clock(self):
+        with self._condition:
+            self._deadline = time.time() + self.timeout
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+
+class PatternQuarantine(object):
+    '''
+    A persistent record, stored as JSON, of the patterns on which TRegex has
+    timed out and the trees (identified by hash) that it got stuck on. May be
+    shared between threads, and any number of processes may share the same
+    file: saving merges this instance's new timeouts into whatever is on disk
+    at the time.
+    '''
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        # (pattern, tree hash, timeout, time) for each timeout not yet saved
+        self._unsaved_timeouts = []
+        self._patterns = self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_path) as quarantine_file:
+                return json.load(quarantine_file)
+        except IOError: # No quarantine yet
+            return {}
+        except ValueError as e:
+            logging.warn('Ignoring unreadable TRegex quarantine %s: %s',
+                         self.file_path, e)
+            return {}
+
+    def __contains__(self, pattern):
+        return pattern in self._patterns
+
+    def get_stuck_tree_hashes(self, pattern):
+        return set(self._patterns[pattern]['stuck_trees'])
+
+    def record_timeout(self, pattern, tree_hash, timeout):
+        with self._lock:
+            timeout_record = (pattern, tree_hash, timeout, time.time())
+            self._apply_timeout(self._patterns, *timeout_record)
+            self._unsaved_timeouts.append(timeout_record)
+
+    @staticmethod
+    def _apply_timeout(patterns, pattern, tree_hash, timeout, timestamp):
+        entry = patterns.setdefault(pattern,
+                                    {'timeouts': 0, 'stuck_trees': []})
+        entry['timeouts'] += 1
+        entry['timeout_seconds'] = timeout
+        entry['last_timeout'] = max(timestamp, entry.get('last_timeout', 0))
+        if tree_hash not in entry['stuck_trees']:
+            entry['stuck_trees'].append(tree_hash)
+
+    def save(self):
+        with self._lock:
+            if not self._unsaved_timeouts:
+                return
+            quarantine_dir = path.dirname(self.file_path)
+            if quarantine_dir and not path.isdir(quarantine_dir):
+                try:
+                    os.makedirs(quarantine_dir)
+                except OSError:
+                    if not path.isdir(quarantine_dir):
+                        raise
+            # Other processes may have saved since we loaded, so re-read the
+            # file and add our timeouts to it, holding a lock so that no one
+            # else saves in between.
+            with open(self.file_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    patterns = self._load()
+                    for timeout_record in self._unsaved_timeouts:
+                        self._apply_timeout(patterns, *timeout_record)
+                    # Write to a temporary file first, so that a crash can't
+                    # leave a truncated quarantine behind.
+                    temp_path = '%s.%d.tmp' % (self.file_path, os.getpid())
+                    with open(temp_path, 'w') as quarantine_file:
+                        json.dump(patterns, quarantine_file, indent=1)
+                    os.rename(temp_path, self.file_path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._patterns = patterns
+            self._unsaved_timeouts = []
+
+
+class PatternStatsLog(object):
+    '''
+    Appends a JSON record of statistics for each pattern run to a JSON-lines
+    file. May be shared between threads.
+    '''
+
+    def __init__(self, log_path):
+        self._file = open(log_path, 'a')
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class PreprocessedCorpus(object):
+    '''
+    The preprocessed trees for a set of sentences, written once to a single
+    tree file (which TRegex workers can load) and memory-mapped, with an index
+    of where each sentence's tree starts. Trees are returned as UTF-8 byte
+    strings.
+    '''
+
+    def __init__(self, ptb_strings):
+        self._offsets = [0]
+        self._tree_hashes = []
+        with tempfile.NamedTemporaryFile('wb', prefix='trees',
+                                         delete=False) as tree_file:
+            self.path = tree_file.name
+            for ptb_string in ptb_strings:
+                if isinstance(ptb_string, unicode):
+                    ptb_string = ptb_string.encode('utf-8')
+                tree_file.write(ptb_string)
+                self._offsets.append(self._offsets[-1] + len(ptb_string))
+                # TRegex results are cached per (pattern, tree), so that
+                # changes to some sentences don't invalidate the results for
+                # all the others.
+                self._tree_hashes.append(hashlib.sha1(ptb_string).hexdigest())
+
+        if self._offsets[-1]: # mmap can't map an empty file
+            with open(self.path, 'rb') as tree_file:
+                self._map = mmap.mmap(tree_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        else:
+            self._map = ''
+
+    def __len__(self):
+        return len(self._tree_hashes)
+
+    def get_tree(self, index):
+        return self._map[self._offsets[index]:self._offsets[index + 1]]
+
+    def get_tree_hash(self, index):
+        return self._tree_hashes[index]
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        os.unlink(self.path)
+
+
+class TRegexWorker(object):
+    '''
+    A long-lived TregexServer process (see stanford-patches), which loads the
+    tree file it is given once and then runs a stream of patterns against
+    subsets of those trees. Its output for each pattern is identical to the
+    output of running tregex.sh with TregexProcessorThread's standard arguments
+    on a file containing just the requested trees.
+    '''
+
+    _END_LINE = '%%END'
+    _ERROR_PREFIX = '%%ERROR'
+
+    def __init__(self, tree_file_path):
+        self.tree_file_path = tree_file_path
+        self._start()
+
+    def _start(self):
+        command = [path.join(FLAGS.tregex_dir, 'tregex_server.sh'),
+                   self.get_output_type_arg(), self.tree_file_path]
+        # Started in a group of its own, like one-shot TRegex processes.
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=TRegexConnectiveModel.TregexProcessorThread.dev_null,
+            preexec_fn=os.setsid)
+
+    def restart(self):
+        '''
+        Replaces the worker's process with a fresh one (e.g., after the old
+        one was killed for taking too long).
+        '''
+        kill_process_group(self.process)
+        self.close()
+        self._start()
+
+    @staticmethod
+    def get_output_type_arg():
+        if FLAGS.tregex_pattern_type == 'dependency':
+            return '-u'
+        else:
+            return '-x'
+
+    def run_pattern(self, pattern, handles, tree_indices):
+        '''
+        Runs `pattern` on the trees at (0-based) `tree_indices` in the worker's
+        tree file, and returns an iterator over TRegex's output lines. The
+        iterator must be exhausted before the next pattern is run.
+        '''
+        request = '%s\n%s\n%s\n' % (
+            ' '.join(handles), ' '.join([str(i + 1) for i in tree_indices]),
+            pattern)
+        self.process.stdin.write(request.encode('utf-8'))
+        self.process.stdin.flush()
+        return self._iter_response_lines(pattern)
+
+    def _iter_response_lines(self, pattern):
+        for line in iter(self.process.stdout.readline, ''):
+            if line.startswith(self._END_LINE):
+                return
+            elif line.startswith(self._ERROR_PREFIX):
+                raise RuntimeError("TRegex worker failed on pattern %s: %s"
+                                   % (pattern, line[len(self._ERROR_PREFIX):]))
+            yield line
+        raise RuntimeError("TRegex worker exited unexpectedly (pattern: %s)"
+                           % pattern)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError: # Process is already gone
+            pass
+        self.process.wait()
+
+
 class TRegexConnectiveStage(Stage):
     def __init__(self, name):
         super(TRegexConnectiveStage, self).__init__(
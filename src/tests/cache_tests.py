@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+
+import multiprocessing
+from os import path
+import shutil
+import tempfile
+import time
+import unittest
+
+from causeway.cache import DiskCache
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.db_path = path.join(self.cache_dir, 'subdir', 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_keys_are_stable(self):
+        self.assertEqual(DiskCache.make_key('a', u'b\xe9'),
+                         DiskCache.make_key(u'a', u'b\xe9'.encode('utf-8')))
+        self.assertNotEqual(DiskCache.make_key('ab', 'c'),
+                            DiskCache.make_key('a', 'bc'))
+
+    def test_get_and_put(self):
+        cache = DiskCache(self.db_path)
+        self.assertIsNone(cache.get('key'))
+        cache.put_many([('key', 'value'), ('key2', 'value2')])
+        self.assertEqual({'key': 'value', 'key2': 'value2'},
+                         cache.get_many(['key', 'key2', 'key3']))
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+        # Replacing a value should update the total size.
+        cache.put('key', 'v')
+        self.assertEqual(len('v') + len('value2'), cache.get_total_size())
+        cache.close()
+
+        # Values should persist across instances.
+        cache = DiskCache(self.db_path)
+        self.assertEqual('v', cache.get('key'))
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = DiskCache(self.db_path, max_bytes=100, touch_interval=0)
+        cache.put('first', 'a' * 40)
+        time.sleep(0.01)
+        cache.put('second', 'b' * 40)
+        time.sleep(0.01)
+        cache.get('first') # now 'second' is least recently used
+        time.sleep(0.01)
+        cache.put('new', 'c' * 40)
+
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual('a' * 40, cache.get('first'))
+        self.assertEqual('c' * 40, cache.get('new'))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(80, cache.get_total_size())
+        cache.close()
+
+    def test_recent_reads_not_recorded(self):
+        cache = DiskCache(self.db_path, max_bytes=100, touch_interval=60)
+        cache.put('first', 'a' * 40)
+        time.sleep(0.01)
+        cache.put('second', 'b' * 40)
+        # 'first' was last used too recently for this read to be recorded...
+        cache.get('first')
+        cache.put('new', 'c' * 40)
+        # ...so it's still the least recently used.
+        self.assertIsNone(cache.get('first'))
+        self.assertEqual('b' * 40, cache.get('second'))
+        cache.close()
+
+    def test_entry_locks(self):
+        cache = DiskCache(self.db_path)
+        locked = multiprocessing.Event()
+        def hold_lock():
+            other_cache = DiskCache(self.db_path)
+            other_cache.lock_entries(['key'])
+            locked.set()
+            time.sleep(0.5)
+            other_cache.put('key', 'value')
+            other_cache.unlock_entries(['key'])
+            other_cache.close()
+        other_process = multiprocessing.Process(target=hold_lock)
+        other_process.start()
+        locked.wait()
+
+        # Other entries aren't blocked...
+        cache.lock_entries(['other key'])
+        cache.unlock_entries(['other key'])
+        # ...but we should wait for the other process to finish with this one.
+        cache.lock_entries(['key'])
+        self.assertEqual('value', cache.get('key'))
+        cache.unlock_entries(['key'])
+        other_process.join()
+        cache.close()
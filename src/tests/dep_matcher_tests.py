@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+
+import unittest
+
+from causeway.tregex_based.dep_matcher import (
+    DependencyPatternMatcher, PTBTree, UnsupportedPatternError)
+
+
+class DependencyPatternMatcherTest(unittest.TestCase):
+    TREE = PTBTree(
+        '(ROOT (cause_2 root VBD (smoking_1 nsubj NN)'
+        ' (cancer_3 dobj NN (lung_4 compound NN)) (cause_2 dep VBD)))\n')
+    HANDLES = ['cause', 'effect', 'connective_0']
+
+    def test_tree_structure(self):
+        self.assertEqual(['ROOT', 'cause_2', 'root', 'VBD', 'smoking_1'],
+                         self.TREE.labels[:5])
+        self.assertEqual([2, 3, 4, 7, 13], self.TREE.children[1])
+        self.assertEqual(1, self.TREE.parents[13])
+
+    def test_path_pattern(self):
+        matcher = DependencyPatternMatcher(
+            '(/.*_[0-9]+/=cause [<1 nsubj | <1 csubj | <1 dep]'
+            ' > (/^cause_[0-9]+$/=connective_0 <2 /^VB.*/'
+            ' < (/.*_[0-9]+/=effect [<1 dobj | <1 dep])))'
+            ' : (=effect !== =cause)', self.HANDLES)
+        # The duplicated node for "cause" (via the dep edge) is a separate
+        # match root, just as it would be for TRegex.
+        self.assertEqual(['smoking_1', 'cancer_3', 'cause_2',
+                          'cause_2', 'cancer_3', 'cause_2'],
+                         matcher.match(self.TREE))
+
+    def test_argument_in_connective(self):
+        matcher = DependencyPatternMatcher(
+            '(/^cause_[0-9]+$/=connective_0 <2 /^VB.*/'
+            ' < (/.*_[0-9]+/=effect [<1 dobj | <1 dep]))'
+            ' : (__=cause == =connective_0) : (=effect !== =cause)',
+            self.HANDLES)
+        self.assertEqual(['cause_2', 'cancer_3', 'cause_2'],
+                         matcher.match(self.TREE))
+
+    def test_no_match(self):
+        matcher = DependencyPatternMatcher(
+            '(/^prevent_[0-9]+$/=connective_0 <2 /^VB.*/'
+            ' < (/.*_[0-9]+/=cause <1 nsubj) < (/.*_[0-9]+/=effect <1 dobj))',
+            self.HANDLES)
+        self.assertEqual([], matcher.match(self.TREE))
+
+    def test_unsupported_patterns(self):
+        for pattern in ['(NP << NN=cause)', '(__=cause $ x)',
+                        '(=cause < y)', '(/a/=cause <-1 y)',
+                        '(/a/=cause [< /b/=effect | < c])']:
+            self.assertRaises(UnsupportedPatternError,
+                              DependencyPatternMatcher, pattern, ['cause'])
+        # Handles must be named in the pattern.
+        self.assertRaises(UnsupportedPatternError, DependencyPatternMatcher,
+                          '(/a/=cause < b)', ['cause', 'effect'])
+
+    def test_merged_patterns(self):
+        patterns = [
+            '(/.*_[0-9]+/=cause [<1 nsubj | <1 dep]'
+            ' > (/^cause_[0-9]+$/=connective_0 <2 /^VB.*/))'
+            ' : (/.*_[0-9]+/=effect <1 dobj > (__=steiner_0 == =connective_0))'
+            ' : (=effect !== =cause)',
+            '(/.*_[0-9]+/=cause [<1 csubj | <1 dep]'
+            ' > (/^cause_[0-9]+$/=connective_0 <2 /^VB.*/))'
+            ' : (/.*_[0-9]+/=effect <1 dobj > (__=steiner_3 == =connective_0))'
+            ' : (=effect !== =cause)',
+            '(/.*_[0-9]+/=cause [<1 nsubj]'
+            ' > (/^cause_[0-9]+$/=connective_0 <2 /^VB.*/))'
+            ' : (/.*_[0-9]+/=effect <1 dobj > (__=steiner_0 == =connective_0))'
+            ' : (=effect !== =cause)']
+        matchers = [DependencyPatternMatcher(pattern, self.HANDLES)
+                    for pattern in patterns]
+        self.assertEqual(1, len(set(matcher.get_signature()
+                                    for matcher in matchers)))
+        merged = DependencyPatternMatcher.merge(matchers)
+        self.assertEqual(patterns, merged.patterns)
+        self.assertEqual([matcher.match(self.TREE) for matcher in matchers],
+                         merged.match_all(self.TREE))
+        self.assertEqual([['smoking_1', 'cancer_3', 'cause_2',
+                           'cause_2', 'cancer_3', 'cause_2'],
+                          ['cause_2', 'cancer_3', 'cause_2'],
+                          ['smoking_1', 'cancer_3', 'cause_2']],
+                         merged.match_all(self.TREE))
+
+        # Different structures can't be merged.
+        other = DependencyPatternMatcher(
+            '(/.*_[0-9]+/=cause <1 nsubj > (/^cause_[0-9]+$/=connective_0'
+            ' < (/.*_[0-9]+/=effect <1 dobj)))', self.HANDLES)
+        self.assertNotEqual(other.get_signature(), matchers[0].get_signature())
+        self.assertRaises(ValueError, DependencyPatternMatcher.merge,
+                          [matchers[0], other])
@@ -0,0 +1,45 @@
+from __future__ import absolute_import
+
+import gflags
+from os import path
+import unittest
+
+from causeway import NERWorker, SentenceSplitStanfordNERTagger
+
+gflags.FLAGS([]) # Prevent UnparsedFlagAccessError
+FLAGS = gflags.FLAGS
+
+MODEL_PATH = path.join(FLAGS.stanford_ner_path, 'classifiers',
+                       FLAGS.stanford_ner_model_name)
+JAR_PATH = path.join(FLAGS.stanford_ner_path, FLAGS.stanford_ner_jar)
+
+
+@unittest.skipUnless(path.exists(MODEL_PATH) and path.exists(JAR_PATH),
+                     'Stanford NER not found at --stanford_ner_path')
+class NERWorkerTest(unittest.TestCase):
+    # Entities in various word shapes (capitalized, all caps, with digits and
+    # punctuation), which is where skipping NER's preprocessing shows.
+    SENTENCES = [
+        'John Smith moved from Boston to IBM in 1999 .',
+        'The U.S. Federal Reserve raised rates , said Ben S. Bernanke .',
+        'MICROSOFT and Apple Inc. sued each other in New York City .',
+        'mcdonald\'s opened 3,000 stores across South-East Asia .',
+    ]
+
+    def test_matches_text_files_tagger(self):
+        sentences = [sentence.split() for sentence in self.SENTENCES]
+        text_file = path.join(path.dirname(__file__), 'resources', 'IAATest',
+                              'iaa_test.txt')
+        with open(text_file) as text:
+            sentences.extend(line.split() for line in text if line.strip())
+
+        baseline_tagger = SentenceSplitStanfordNERTagger(MODEL_PATH, JAR_PATH)
+        worker = NERWorker(MODEL_PATH, JAR_PATH)
+        try:
+            # Only the tags matter; NLTK re-parses the words from NER's output.
+            get_tags = lambda results: [[tag for _word, tag in result]
+                                        for result in results]
+            self.assertEqual(get_tags(baseline_tagger.tag_sents(sentences)),
+                             get_tags(worker.tag_sents(sentences)))
+        finally:
+            worker.close()
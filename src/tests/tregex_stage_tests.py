@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+
+from collections import deque
+import gflags
+from os import path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from causeway.cache import DiskCache
+from causeway.tregex_based.tregex_stage import (
+    PatternQuarantine, PreprocessedCorpus, TRegexConnectiveModel, TRegexWorker,
+    Watchdog)
+
+gflags.FLAGS([]) # Prevent UnparsedFlagAccessError
+
+
+class FakeTregexServerProcess(object):
+    '''
+    Stands in for a TregexServer process. Requests written to stdin are
+    answered on stdout, all through one stream, like the real server's pipe.
+    For each requested tree, the output is a single line naming the pattern
+    and the tree number.
+    '''
+
+    def __init__(self):
+        self.requests = []
+        self._output = deque()
+        self.stdin = self
+        self.stdout = self
+
+    def write(self, request):
+        _handles, tree_numbers, pattern = request.strip('\n').split('\n')
+        self.requests.append(pattern)
+        for position, tree_number in enumerate(tree_numbers.split(), 1):
+            self._output.extend(['%d:\n' % position,
+                                 '%s %s\n' % (pattern, tree_number), '\n'])
+        self._output.append('%%END\n')
+
+    def flush(self):
+        pass
+
+    def readline(self):
+        return self._output.popleft() if self._output else ''
+
+    def close(self):
+        pass
+
+    def wait(self):
+        return 0
+
+
+class FakeTRegexWorker(TRegexWorker):
+    def _start(self):
+        self.process = FakeTregexServerProcess()
+
+
+class RecordingProcessorThread(TRegexConnectiveModel.TregexProcessorThread):
+    '''
+    Records the output lines it gets for each sentence, rather than turning
+    them into PossibleCausations.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingProcessorThread, self).__init__(*args, **kwargs)
+        self.outputs = []
+
+    def _process_tregex_for_sentence(self, pattern, connective_labels,
+                                     connective_lemmas, sentence, lines):
+        self.outputs.append((pattern, sentence, lines))
+        return []
+
+
+class TRegexWorkerOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sentences = ['first', 'second', 'third']
+        self.corpus = PreprocessedCorpus(
+            ['(ROOT (A %s))\n' % sentence for sentence in self.sentences])
+        self.cache = DiskCache(path.join(self.temp_dir, 'cache.db'))
+        self.worker = FakeTRegexWorker(self.corpus.path)
+        self.thread = RecordingProcessorThread(
+            self.sentences, self.corpus, [None] * len(self.sentences), [],
+            [[] for _ in self.sentences], self.cache, {},
+            PatternQuarantine(path.join(self.temp_dir, 'quarantine.json')),
+            worker=self.worker)
+
+    def tearDown(self):
+        self.cache.close()
+        self.corpus.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _run_pattern(self, pattern, sentence_indices):
+        self.thread.outputs = []
+        self.thread._process_pattern(
+            pattern, [], [],
+            [(i, self.sentences[i]) for i in sentence_indices], None)
+        return self.thread.outputs
+
+    def test_consecutive_patterns(self):
+        self.assertEqual(
+            [('A', 'first', ['A 1']), ('A', 'third', ['A 3'])],
+            self._run_pattern('A', [0, 2]))
+        # The second pattern should get its own output, not what's left over
+        # from the first.
+        self.assertEqual([('B', 'second', ['B 2'])],
+                         self._run_pattern('B', [1]))
+        self.assertEqual(['A', 'B'], self.worker.process.requests)
+
+        # Both patterns' output should have been cached.
+        self.assertEqual(
+            [('A', 'first', ['A 1']), ('B', 'second', ['B 2'])],
+            self._run_pattern('A', [0]) + self._run_pattern('B', [1]))
+        self.assertEqual(['A', 'B'], self.worker.process.requests)
+
+
+class WatchdogTest(unittest.TestCase):
+    def test_timeout_counts_from_restart(self):
+        timed_out = threading.Event()
+        watchdog = Watchdog(0.5, timed_out.set)
+        watchdog.stop_clock()
+        # A stopped clock never runs out...
+        self.assertFalse(timed_out.wait(0.7))
+        # ...and once it's restarted, the full timeout should be allowed, but
+        # no more.
+        restart_time = time.time()
+        watchdog.restart_clock()
+        self.assertTrue(timed_out.wait(2))
+        self.assertAlmostEqual(0.5, time.time() - restart_time, delta=0.2)
+        watchdog.stop()
+        self.assertTrue(watchdog.fired)
+
+    def test_stop(self):
+        timed_out = threading.Event()
+        watchdog = Watchdog(0.2, timed_out.set)
+        watchdog.stop()
+        self.assertFalse(timed_out.wait(0.4))
+        self.assertFalse(watchdog.fired)